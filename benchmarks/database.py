@@ -0,0 +1,377 @@
+"""
+Seed a MariaDB database with a production sized synthetic dataset and time the bot's queries
+against it under concurrent load. Results are saved as json for comparing before and after.
+
+Uses the credentials from .env, but a separate database that is created if it doesn't exist,
+so the user needs the privileges to create it. The dataset is seeded on the first run only.
+
+    $ python -m benchmarks.database
+    $ python -m benchmarks.database --concurrency 32 --iterations 2000
+    $ python -m benchmarks.database --reseed --follows 500000 --users 100000
+    $ python -m benchmarks.database --compare benchmarks/results/database-20221101-120000.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import aiomysql
+from dotenv import load_dotenv
+from loguru import logger
+
+from modules import maria, migrations, queries, settings
+from modules.settings import SettingsCache
+
+RESULTS_DIR = Path("benchmarks/results")
+SCHEMA = Path("sql/schema.sql")
+# children before parents, because of the foreign keys
+TABLES = [
+    "follow",
+    "user_rule",
+    "channel_rule",
+    "guild_settings",
+    "guild",
+    "pending_deletion",
+    "twitter_user",
+    "schema_version",
+]
+FIRST_GUILD_ID = 10**17
+FIRST_CHANNEL_ID = 2 * 10**17
+FIRST_USER_ID = 10**6
+INSERT_CHUNK = 5000
+
+PURGE_FOLLOWS = maria.Query("purge", "SELECT channel_id, guild_id, twitter_user_id FROM follow")
+# earlier versions of get_all_users and purge, kept to compare against the current ones
+LEGACY_ALL_USERS = maria.Query(
+    "legacy_get_all_users",
+    "SELECT DISTINCT username FROM follow JOIN twitter_user ON twitter_user_id = user_id",
+)
+LEGACY_PURGE_FOLLOWS = maria.Query(
+    "legacy_purge",
+    """
+    SELECT channel_id, guild_id, twitter_user_id, username
+    FROM follow JOIN twitter_user ON twitter_user_id = user_id
+    """,
+)
+
+# these read the whole follow table, so they are run less often
+FULL_SCANS = {
+    "get_filter",
+    "get_follow_pairs",
+    "get_follow_checksum",
+    "legacy_get_all_users",
+    "purge",
+    "legacy_purge",
+}
+
+
+def credentials() -> dict:
+    return {
+        "host": os.environ.get("DB_HOST", "localhost"),
+        "port": int(os.environ["DB_PORT"]),
+        "user": os.environ["DB_USER"],
+        "password": os.environ["DB_PASS"],
+    }
+
+
+async def create_database(name: str):
+    conn = await aiomysql.connect(**credentials())
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    finally:
+        conn.close()
+
+
+async def follow_rows(db) -> list[tuple[int, int, int]]:
+    try:
+        return list(await db.execute(PURGE_FOLLOWS))
+    except Exception:
+        # the tables don't exist yet
+        return []
+
+
+async def seed(db, args, rng: random.Random) -> list[tuple[int, int, int]]:
+    """Recreate the schema and fill it with synthetic guilds, users, follows and rules."""
+    for table in TABLES:
+        await db.execute(f"DROP TABLE IF EXISTS {table}")
+    for statement in migrations.split_statements(SCHEMA.read_text()):
+        await db.execute(statement)
+    await migrations.migrate(db)
+
+    guild_ids = [FIRST_GUILD_ID + i for i in range(args.guilds)]
+    channels = []
+    for guild_id in guild_ids:
+        for _ in range(rng.randint(1, 5)):
+            channels.append((FIRST_CHANNEL_ID + len(channels), guild_id))
+    user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+
+    # a few popular accounts are followed by many channels, most by only a few
+    pairs = {}
+    while len(pairs) < args.follows:
+        channel_id, guild_id = rng.choice(channels)
+        user_id = user_ids[int(len(user_ids) * rng.random() ** 3)]
+        pairs[(channel_id, user_id)] = guild_id
+    follows = [(channel_id, guild_id, user_id) for (channel_id, user_id), guild_id in pairs.items()]
+
+    now = datetime.now()
+    await insert(
+        db,
+        "INSERT INTO twitter_user VALUES (%s, %s)",
+        [(user_id, f"user{user_id}") for user_id in user_ids],
+    )
+    await insert(
+        db,
+        "INSERT INTO guild (guild_id, follow_limit, follow_count) VALUES (%s, %s, 0)",
+        [(guild_id, 25) for guild_id in guild_ids],
+    )
+    await insert(
+        db,
+        "INSERT INTO follow VALUES (%s, %s, %s, %s)",
+        [(channel_id, guild_id, user_id, now) for channel_id, guild_id, user_id in follows],
+    )
+    await insert(
+        db,
+        "INSERT INTO guild_settings VALUES (%s, %s, %s)",
+        [(guild_id, rng.random() < 0.3, rng.random() < 0.8) for guild_id in guild_ids[::2]],
+    )
+    await insert(
+        db,
+        "INSERT INTO channel_rule (guild_id, channel_id, media_only) VALUES (%s, %s, %s)",
+        [
+            (guild_id, channel_id, True)
+            for channel_id, guild_id in rng.sample(channels, len(channels) // 10)
+        ],
+    )
+    user_rules = {
+        (guild_id, user_id) for _, guild_id, user_id in rng.sample(follows, len(follows) // 20)
+    }
+    await insert(
+        db,
+        "INSERT INTO user_rule (guild_id, twitter_user_id, media_only) VALUES (%s, %s, %s)",
+        [(guild_id, user_id, False) for guild_id, user_id in user_rules],
+    )
+    await db.execute(
+        """
+        UPDATE guild SET follow_count = (
+            SELECT COUNT(DISTINCT twitter_user_id) FROM follow
+            WHERE follow.guild_id = guild.guild_id
+        )
+        """
+    )
+    return follows
+
+
+async def insert(db, statement: str, rows: list[tuple]):
+    for i in range(0, len(rows), INSERT_CHUNK):
+        await db.executemany(statement, rows[i : i + INSERT_CHUNK])
+
+
+def operations(db, follows: list[tuple[int, int, int]]) -> dict:
+    channels_by_user = defaultdict(list)
+    for channel_id, guild_id, user_id in follows:
+        channels_by_user[user_id].append(
+            SimpleNamespace(id=channel_id, guild=SimpleNamespace(id=guild_id))
+        )
+    user_ids = list(channels_by_user)
+    guild_ids = list({guild_id for _, guild_id, _ in follows})
+
+    async def get_channels(rng):
+        await queries.get_channels(db, rng.choice(user_ids))
+
+    async def tweet_config(rng):
+        user_id = rng.choice(user_ids)
+        await queries.tweet_configs(db, channels_by_user[user_id], user_id)
+
+    async def get_follow_limit(rng):
+        await queries.get_follow_limit(db, rng.choice(guild_ids))
+
+    async def list_follows(rng):
+        await queries.list_follows(db, rng.choice(guild_ids))
+
+    async def load_guild_settings(rng):
+        guild_id = rng.choice(guild_ids)
+        await db.execute(settings.LOAD_GUILD_SETTINGS, guild_id, guild_id, guild_id)
+
+    async def get_filter(rng):
+        await queries.get_filter(db)
+
+    async def get_follow_pairs(rng):
+        await queries.get_follow_pairs(db)
+
+    async def get_follow_checksum(rng):
+        await queries.get_follow_checksum(db)
+
+    async def legacy_get_all_users(rng):
+        await db.execute(LEGACY_ALL_USERS)
+
+    async def purge(rng):
+        await db.execute(PURGE_FOLLOWS)
+
+    async def legacy_purge(rng):
+        await db.execute(LEGACY_PURGE_FOLLOWS)
+
+    return {
+        "get_channels": get_channels,
+        "tweet_config": tweet_config,
+        "get_follow_limit": get_follow_limit,
+        "list": list_follows,
+        "load_guild_settings": load_guild_settings,
+        "get_filter": get_filter,
+        "get_follow_pairs": get_follow_pairs,
+        "get_follow_checksum": get_follow_checksum,
+        "legacy_get_all_users": legacy_get_all_users,
+        "purge": purge,
+        "legacy_purge": legacy_purge,
+    }
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def measure(operation, calls: int, concurrency: int, seed: int) -> dict:
+    """Run the operation `calls` times split between `concurrency` concurrent workers."""
+    latencies = []
+
+    async def worker(n: int):
+        rng = random.Random(seed + n)
+        for _ in range(n, calls, concurrency):
+            started = time.perf_counter()
+            await operation(rng)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "calls": len(latencies),
+        "seconds": elapsed,
+        "per_second": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def print_results(results: dict, baseline: dict):
+    previous = baseline.get("operations", {})
+    print(
+        f"{'operation':<20} {'calls':>6} {'ops/s':>9} "
+        f"{'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}"
+    )
+    for name, r in results["operations"].items():
+        line = (
+            f"{name:<20} {r['calls']:>6} {r['per_second']:>9.1f} {r['p50'] * 1000:>7.2f}ms "
+            f"{r['p95'] * 1000:>7.2f}ms {r['p99'] * 1000:>7.2f}ms {r['max'] * 1000:>7.2f}ms"
+        )
+        if name in previous:
+            change = (r["p50"] - previous[name]["p50"]) / previous[name]["p50"] * 100
+            line += f" {change:+6.1f}% p50"
+        print(line)
+
+
+async def run(args) -> dict:
+    await create_database(args.database)
+    config = SimpleNamespace(
+        dbcredentials={**credentials(), "db": args.database},
+        db_pool_min=1,
+        db_pool_max=args.concurrency,
+        db_pool_recycle=3600,
+        db_acquire_timeout=60,
+        slow_query_ms=float("inf"),
+    )
+    # a cache that keeps nothing, so that every tweet config comes from the database
+    bot = SimpleNamespace(config=config, settings_cache=SettingsCache(max_guilds=0))
+    db = maria.MariaDB(bot)
+    bot.db = db
+    await db.initialize_pool()
+
+    try:
+        rng = random.Random(args.seed)
+        follows = [] if args.reseed else await follow_rows(db)
+        if not follows:
+            print(f"Seeding {args.database}...")
+            started = time.perf_counter()
+            follows = await seed(db, args, rng)
+            print(f"Seeded {len(follows)} follows in {time.perf_counter() - started:.1f}s")
+
+        results = {
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "database": args.database,
+            "follows": len(follows),
+            "users": len({user_id for _, _, user_id in follows}),
+            "guilds": len({guild_id for _, guild_id, _ in follows}),
+            "concurrency": args.concurrency,
+            "operations": {},
+        }
+        for name, operation in operations(db, follows).items():
+            calls = args.iterations
+            if name in FULL_SCANS:
+                calls = max(args.concurrency, args.iterations // 50)
+            results["operations"][name] = await measure(
+                operation, calls, args.concurrency, args.seed
+            )
+        return results
+    finally:
+        await db.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--database", default="siniara_benchmark")
+    parser.add_argument("--reseed", action="store_true", help="recreate the dataset")
+    parser.add_argument("--guilds", type=int, default=3000)
+    parser.add_argument("--users", type=int, default=30000)
+    parser.add_argument("--follows", type=int, default=150000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=1000, help="calls per operation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="where to save the results")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    args = parser.parse_args()
+
+    if not re.fullmatch(r"\w+", args.database):
+        parser.error("invalid database name")
+
+    load_dotenv()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    results = asyncio.run(run(args))
+
+    baseline = {}
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+    print_results(results, baseline)
+
+    output = Path(args.output or RESULTS_DIR / f"database-{datetime.now():%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Time the pure functions on the tweet and rule paths at production scale.
+
+Each benchmark is run in `--repeat` rounds and the best and median time per call are reported.
+With --compare the results are checked against an earlier --output file, and the script exits
+with an error if anything got slower by more than --tolerance.
+
+    $ python -m benchmarks.hot_functions
+    $ python -m benchmarks.hot_functions --usernames 50000 --urls 20 --output before.json
+    $ python -m benchmarks.hot_functions --compare before.json --tolerance 0.1
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+import discord
+import tweepy
+
+from benchmarks.rule_packing import random_usernames
+from cogs.asyncstreamer import Streamer
+from modules import rules
+from modules.twitter import TwitterRenderer
+from modules.ui import RowPaginator
+
+WORD_CHARS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def streamer(packing: str) -> SimpleNamespace:
+    """Just enough of the cog for calling its rule methods."""
+    return SimpleNamespace(bot=SimpleNamespace(config=SimpleNamespace(rule_packing=packing)))
+
+
+def tweet_with_urls(count: int, rng: random.Random) -> tuple[str, list[dict]]:
+    """Tweet text with `count` t.co links and their url entities, like the v2 api returns them."""
+    text = ""
+    urls = []
+    for i in range(count):
+        text += " ".join(
+            "".join(rng.choices(WORD_CHARS, k=rng.randint(2, 8))) for _ in range(rng.randint(1, 6))
+        )
+        text += " "
+        short_url = "https://t.co/" + "".join(rng.choices(WORD_CHARS, k=10))
+        url = {
+            "start": len(text),
+            "end": len(text) + len(short_url),
+            "url": short_url,
+            "expanded_url": f"https://example.com/{i}/" + "x" * rng.randint(10, 60),
+            "display_url": f"example.com/{i}/…",
+        }
+        kind = rng.random()
+        if kind < 0.2:
+            url["media_key"] = f"3_{i}"
+        elif kind < 0.3:
+            url["display_url"] = f"twitter.com/i/web/status/{i}"
+        urls.append(url)
+        text += short_url + " "
+    return text, urls
+
+
+def media_list(count: int, rng: random.Random) -> list[tweepy.Media]:
+    media = []
+    for i in range(count):
+        if rng.random() < 0.7:
+            data = {
+                "media_key": f"3_{i}",
+                "type": "photo",
+                "url": f"https://pbs.twimg.com/media/{i}.jpg",
+            }
+        else:
+            variants = [
+                {
+                    "content_type": "video/mp4",
+                    "bit_rate": rng.choice([256000, 832000, 2176000, 10368000]),
+                    "url": f"https://video.twimg.com/{i}/{n}.mp4",
+                }
+                for n in range(4)
+            ]
+            # the playlist variant has no bit rate
+            variants.append(
+                {
+                    "content_type": "application/x-mpegURL",
+                    "url": f"https://video.twimg.com/{i}.m3u8",
+                }
+            )
+            data = {"media_key": f"7_{i}", "type": "video", "variants": variants}
+        media.append(tweepy.Media(data))
+    return media
+
+
+def measure(function: Callable[[], object], number: int, repeat: int) -> dict:
+    """Seconds per call over `repeat` rounds of `number` calls."""
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        rounds.append((time.perf_counter() - started) / number)
+    return {"number": number, "best": min(rounds), "median": statistics.median(rounds)}
+
+
+async def measure_paginator(rows: list[str], per_page: int, number: int, repeat: int) -> dict:
+    """Build a paginator and format every one of its pages, like paging through all of them."""
+
+    async def run():
+        paginator = RowPaginator(discord.Embed(title="Benchmark"), rows, per_page=per_page)
+        for page in paginator.pages:
+            await paginator.format_page(page)
+
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            await run()
+        rounds.append((time.perf_counter() - started) / number)
+    return {"number": number, "best": min(rounds), "median": statistics.median(rounds)}
+
+
+def run_benchmarks(args) -> dict:
+    rng = random.Random(args.seed)
+    usernames = random_usernames(args.usernames, rng)
+    text, urls = tweet_with_urls(args.urls, rng)
+    media = media_list(args.media, rng)
+    rows = [f"`#{i}` **user{i}** <#{rng.getrandbits(60)}>" for i in range(args.rows)]
+
+    results = {}
+    for packing in rules.PACKERS:
+        cog = streamer(packing)
+        stream_rules = Streamer.rule_builder(cog, usernames)  # type: ignore
+        results[f"rule_builder[{packing}]"] = measure(
+            lambda: Streamer.rule_builder(cog, usernames), 1, args.repeat  # type: ignore
+        )
+        results[f"deconstruct_rules[{packing}]"] = measure(
+            lambda: Streamer.deconstruct_rules(cog, stream_rules), 10, args.repeat  # type: ignore
+        )
+    results["expand_links"] = measure(
+        lambda: TwitterRenderer.expand_links(text, urls), 10000, args.repeat
+    )
+    results["tweepy_get_media"] = measure(
+        lambda: TwitterRenderer.tweepy_get_media(media), 10000, args.repeat
+    )
+    results["paginator"] = asyncio.run(measure_paginator(rows, 10, 10, args.repeat))
+    return results
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    slower = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is not None and result["best"] > previous["best"] * (1 + tolerance):
+            change = result["best"] / previous["best"] - 1
+            slower.append(f"{name} is {change:.0%} slower")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--usernames", type=int, default=50000, help="followed accounts")
+    parser.add_argument("--urls", type=int, default=20, help="url entities in the tweet")
+    parser.add_argument("--media", type=int, default=4, help="media in the tweet")
+    parser.add_argument("--rows", type=int, default=5000, help="paginator rows")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    parser.add_argument("--output", help="save the results as json")
+    parser.add_argument("--compare", help="earlier results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'benchmark':<32} {'best':>12} {'median':>12}")
+        for name, result in results.items():
+            print(
+                f"{name:<32} {result['best'] * 10**6:>10.2f}us {result['median'] * 10**6:>10.2f}us"
+            )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        slower = regressions(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for line in slower:
+            print(line, file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
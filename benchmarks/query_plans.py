@@ -0,0 +1,68 @@
+"""
+EXPLAIN the hot path queries and fail if any of them scans a whole table.
+Reads the database credentials from .env like the bot does. On nearly empty tables
+the optimizer may prefer a full scan anyway, so run this against realistic data.
+
+    $ python -m benchmarks.query_plans
+"""
+import asyncio
+import os
+import sys
+
+import aiomysql
+from dotenv import load_dotenv
+
+from modules import queries, settings
+
+# (name, statement, parameters)
+HOT_QUERIES = [
+    ("get_channels", queries.GET_CHANNELS.sql, (0,)),
+    ("get_filter", queries.GET_FILTER.sql, ()),
+    ("get_follow_limit", queries.GET_FOLLOW_LIMIT.sql, (0,)),
+    ("refresh_follow_counts", queries.REFRESH_FOLLOW_COUNTS.sql, ([0],)),
+    ("load_guild_settings", settings.LOAD_GUILD_SETTINGS.sql, (0, 0, 0)),
+    ("list", queries.LIST_FOLLOWS.sql, (0,)),
+    ("list_channel", queries.LIST_CHANNEL_FOLLOWS.sql, (0, 0)),
+    ("rule_user", queries.IS_FOLLOWED_IN_GUILD.sql, (0, 0)),
+    ("tweet_configs", queries.tweet_configs_query(1).sql, (0, 0, 0)),
+]
+
+# tables that grow with the number of follows and rules, a full scan of these is a regression
+LARGE_TABLES = {"follow", "twitter_user", "channel_rule", "user_rule"}
+
+
+async def explain(cur, statement: str, params: tuple) -> list[dict]:
+    await cur.execute("EXPLAIN " + statement, params)
+    return await cur.fetchall()
+
+
+async def main() -> int:
+    load_dotenv()
+    conn = await aiomysql.connect(
+        host=os.environ.get("DB_HOST", "localhost"),
+        port=int(os.environ["DB_PORT"]),
+        user=os.environ["DB_USER"],
+        password=os.environ["DB_PASS"],
+        db=os.environ["DB_NAME"],
+    )
+    failures = 0
+    try:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            for name, statement, params in HOT_QUERIES:
+                for row in await explain(cur, statement, params):
+                    full_scan = row["type"] == "ALL" and row["table"] in LARGE_TABLES
+                    failures += full_scan
+                    print(
+                        f"{'FAIL' if full_scan else 'ok':>4} {name:<20} {row['table'] or '-':<14} "
+                        f"{row['type'] or '-':<7} {row['key'] or '-':<22} {row['rows']}"
+                    )
+    finally:
+        conn.close()
+
+    if failures:
+        print(f"{failures} full table scans in hot queries")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
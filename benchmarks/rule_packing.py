@@ -0,0 +1,75 @@
+"""
+Compare the stream rule packers on synthetic usernames.
+
+    $ python -m benchmarks.rule_packing
+    $ python -m benchmarks.rule_packing --sizes 1000 10000 50000 --repeat 5
+"""
+import argparse
+import random
+import string
+import time
+
+from modules import rules
+
+USERNAME_CHARS = string.ascii_letters + string.digits + "_"
+
+
+def random_usernames(count: int, rng: random.Random) -> list[str]:
+    usernames = {}
+    while len(usernames) < count:
+        # twitter usernames are 4 to 15 characters, the short ones are rare
+        length = min(15, max(4, int(rng.gauss(10, 3))))
+        username = "".join(rng.choices(USERNAME_CHARS, k=length))
+        usernames[username.lower()] = username
+    return list(usernames.values())
+
+
+def lower_bound(usernames: list[str]) -> int:
+    total = sum(rules.clause_length(u) for u in usernames)
+    capacity = rules.MAX_RULE_LENGTH - rules.RULE_OVERHEAD
+    return -(-total // capacity)
+
+
+def time_packer(packer, usernames: list[str], repeat: int) -> tuple[float, list[list[str]]]:
+    best = float("inf")
+    groups = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        groups = packer(usernames)
+        best = min(best, time.perf_counter() - start)
+    return best, groups
+
+
+def rules_touched_by_one_new_user(packing: str, usernames: list[str], rng: random.Random) -> int:
+    """How many rule additions and deletions following one more user costs."""
+    manager = rules.RuleManager(None, packing)
+    manager.rules = {str(i): group for i, group in enumerate(manager.pack(usernames))}
+    new_user = random_usernames(1, rng)[0]
+    to_add, to_delete = manager.plan(usernames + [new_user])
+    return len(to_add) + len(to_delete)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'users':>7} {'packer':>7} {'rules':>6} {'bound':>6} {'time':>10} {'churn':>6}")
+    for size in args.sizes:
+        usernames = random_usernames(size, rng)
+        for name, packer in rules.PACKERS.items():
+            seconds, groups = time_packer(packer, usernames, args.repeat)
+            assert all(rules.rule_length(g) <= rules.MAX_RULE_LENGTH for g in groups)
+            assert sum(len(g) for g in groups) == size
+            churn = rules_touched_by_one_new_user(name, usernames, rng)
+            print(
+                f"{size:>7} {name:>7} {len(groups):>6} {lower_bound(usernames):>6} "
+                f"{seconds * 1000:>8.2f}ms {churn:>6}"
+            )
+
+
+if __name__ == "__main__":
+    main()
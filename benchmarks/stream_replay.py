@@ -0,0 +1,343 @@
+"""
+Replay a tweet stream through the real dispatch path and measure its throughput.
+
+Tweets go through RunForeverClient.on_data exactly like the filtered stream delivers them.
+Tweet lookups are answered by a fake tweepy client, media is served by a local aiohttp server,
+and Discord channels are replaced by fakes that record how long each tweet took to arrive.
+
+    $ python -m benchmarks.stream_replay
+    $ python -m benchmarks.stream_replay --tweets 2000 --fanout 20 --media-size 2000000
+    $ python -m benchmarks.stream_replay --profile burst --burst-size 200 --rate 100
+    $ python -m benchmarks.stream_replay --write stream.ndjson
+    $ python -m benchmarks.stream_replay --input stream.ndjson
+
+Recorded streams are NDJSON in the filtered stream format, one {"data": {...}} per line.
+Tweets without attachments.media_keys get --media-count media files.
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import aiohttp
+import tweepy
+from aiohttp import web
+from loguru import logger
+
+from cogs.asyncstreamer import RunForeverClient
+from modules import tracing
+from modules.routing import RoutingIndex
+from modules.scheduler import SendScheduler
+from modules.settings import SettingsCache
+from modules.tracing import Tracer
+from modules.twitter import TweetLoader
+
+FIRST_TWEET_ID = 1600000000000000000
+FIRST_AUTHOR_ID = 1000
+FIRST_GUILD_ID = 10**17
+FIRST_CHANNEL_ID = 2 * 10**17
+
+
+def synthetic_stream(tweets: int, authors: int, media_count: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    lines = []
+    for i in range(tweets):
+        tweet_id = str(FIRST_TWEET_ID + i)
+        data = {
+            "id": tweet_id,
+            "author_id": str(FIRST_AUTHOR_ID + rng.randrange(authors)),
+            "text": f"synthetic tweet {i}",
+            "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "edit_history_tweet_ids": [tweet_id],
+        }
+        if media_count:
+            data["attachments"] = {"media_keys": [f"3_{tweet_id}_{n}" for n in range(media_count)]}
+        lines.append({"data": data})
+    return lines
+
+
+class CDN:
+    """Serves media files of the size encoded in the url."""
+
+    def __init__(self):
+        self.runner: web.AppRunner
+        self.port = 0
+        self.blobs: dict[int, bytes] = {}
+        self.served = 0
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/media/{size}/{name}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def url(self, size: int, name: str) -> str:
+        return f"http://127.0.0.1:{self.port}/media/{size}/{name}.jpg"
+
+    async def handle(self, request: web.Request) -> web.Response:
+        size = int(request.match_info["size"])
+        blob = self.blobs.get(size)
+        if blob is None:
+            blob = self.blobs[size] = random.randbytes(size)
+        self.served += size
+        return web.Response(body=blob, headers={"Cache-Control": "no-store"})
+
+
+class FakeTweepy:
+    """Answers get_tweets from the replayed stream itself."""
+
+    def __init__(self, stream: list[dict], cdn: CDN, media_count: int, media_size: int, latency):
+        self.tweets = {int(line["data"]["id"]): line["data"] for line in stream}
+        self.cdn = cdn
+        self.media_count = media_count
+        self.media_size = media_size
+        self.latency = latency
+        self.calls = 0
+
+    async def get_tweets(self, ids, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        tweets, users, media = [], {}, []
+        for tweet_id in ids:
+            data = dict(self.tweets[tweet_id])
+            data.setdefault("conversation_id", data["id"])
+            keys = (data.get("attachments") or {}).get("media_keys")
+            if keys is None:
+                keys = [f"3_{tweet_id}_{n}" for n in range(self.media_count)]
+                data["attachments"] = {"media_keys": keys}
+            tweets.append(tweepy.Tweet(data))
+            for key in keys:
+                url = self.cdn.url(self.media_size, key)
+                media.append(tweepy.Media({"media_key": key, "type": "photo", "url": url}))
+            author_id = data["author_id"]
+            users[author_id] = tweepy.User(
+                {"id": author_id, "name": f"user {author_id}", "username": f"user{author_id}"}
+            )
+        return tweepy.Response(tweets, {"users": list(users.values()), "media": media}, [], {})
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.messages = 0
+        self.files = 0
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, filesize_limit: int):
+        self.id = guild_id
+        self.filesize_limit = filesize_limit
+        self.owner = None
+        self.owner_id = None
+
+
+class FakeChannel:
+    """Stands in for a discord text channel, sending takes `latency` seconds."""
+
+    def __init__(self, channel_id: int, guild: FakeGuild, latency: float, recorder: Recorder):
+        self.id = channel_id
+        self.guild = guild
+        self.latency = latency
+        self.recorder = recorder
+
+    def __str__(self):
+        return f"fake-{self.id}"
+
+    async def send(self, content=None, *, files=None, embed=None, view=None):
+        await asyncio.sleep(self.latency)
+        self.recorder.messages += 1
+        self.recorder.files += len(files or [])
+        trace = tracing.current_trace.get()
+        if trace is not None:
+            self.recorder.latencies.append(time.perf_counter() - trace.received_at)
+
+
+class FakeDB:
+    """Every channel has the default settings."""
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    async def execute(self, statement, *params, **kwargs):
+        *destinations, _ = params
+        return [
+            (destinations[i], destinations[i + 1], None, None, None, None)
+            for i in range(0, len(destinations), 2)
+        ]
+
+
+class FakeBot:
+    def __init__(self, args, tweepy_client, session: aiohttp.ClientSession):
+        self.config = SimpleNamespace(
+            dispatch_workers=args.workers,
+            dispatch_queue_size=args.queue_size,
+        )
+        self.tweepy = tweepy_client
+        self.session = session
+        self.db = FakeDB(self)
+        self.routing = RoutingIndex(self)
+        self.settings_cache = SettingsCache()
+        self.tweet_loader = TweetLoader(self)
+        self.send_scheduler = SendScheduler(args.send_concurrency)
+        self.tracer = Tracer()
+        self.media_cache = SimpleNamespace(get=self.no_cache, put=self.no_cache)
+        self.reaper = None
+        self.recorder = Recorder()
+        self.channels: dict[int, FakeChannel] = {}
+
+    @staticmethod
+    async def no_cache(*args):
+        return None
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    def follow(self, authors: list[int], fanout: int, guilds: int, latency: float):
+        """Follow every author in `fanout` channels spread over `guilds` guilds."""
+        guild_list = [FakeGuild(FIRST_GUILD_ID + i, 8 * 1024**2) for i in range(guilds)]
+        channel_id = FIRST_CHANNEL_ID
+        for author_id in authors:
+            for n in range(fanout):
+                guild = guild_list[(author_id + n) % guilds]
+                self.channels[channel_id] = FakeChannel(channel_id, guild, latency, self.recorder)
+                self.routing.add(channel_id, author_id)
+                channel_id += 1
+
+
+def schedule(count: int, profile: str, rate: float, burst_size: int) -> list[float]:
+    """Seconds after the start at which each tweet arrives."""
+    if profile == "flood" or rate <= 0:
+        return [0.0] * count
+    if profile == "burst":
+        return [(i // burst_size) * burst_size / rate for i in range(count)]
+    return [i / rate for i in range(count)]
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def replay(args, stream: list[dict]) -> dict:
+    cdn = CDN()
+    await cdn.start()
+    session = aiohttp.ClientSession()
+    fake_tweepy = FakeTweepy(stream, cdn, args.media_count, args.media_size, args.api_latency)
+    bot = FakeBot(args, fake_tweepy, session)
+    authors = sorted({int(line["data"]["author_id"]) for line in stream})
+    bot.follow(authors, args.fanout, args.guilds, args.send_latency)
+
+    client = RunForeverClient(bot, bearer_token="replay")
+    client.dispatcher.start()
+
+    arrivals = schedule(len(stream), args.profile, args.rate, args.burst_size)
+    raw_lines = [json.dumps(line) for line in stream]
+    started = time.perf_counter()
+    for arrival, raw in zip(arrivals, raw_lines):
+        delay = started + arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await client.on_data(raw)
+    await client.dispatcher.queue.join()
+    elapsed = time.perf_counter() - started
+
+    await client.dispatcher.drain()
+    await session.close()
+    await cdn.stop()
+
+    latencies = bot.recorder.latencies
+    return {
+        "tweets": len(stream),
+        "messages": bot.recorder.messages,
+        "files": bot.recorder.files,
+        "seconds": elapsed,
+        "tweets_per_second": len(stream) / elapsed,
+        "messages_per_second": bot.recorder.messages / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "lookups": fake_tweepy.calls,
+        "media_mb": cdn.served / 1024**2,
+        # kilobytes on linux, bytes on macos
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {
+            stage: percentile(list(samples), 50)
+            for stage, samples in bot.tracer.samples.items()
+            if samples
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--input", help="NDJSON stream to replay instead of synthetic tweets")
+    parser.add_argument("--write", help="write the synthetic stream to this file and exit")
+    parser.add_argument("--tweets", type=int, default=500)
+    parser.add_argument("--authors", type=int, default=100)
+    parser.add_argument("--fanout", type=int, default=5, help="channels following each author")
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--media-count", type=int, default=1)
+    parser.add_argument("--media-size", type=int, default=500_000, help="bytes per media file")
+    parser.add_argument("--profile", choices=["steady", "burst", "flood"], default="steady")
+    parser.add_argument("--rate", type=float, default=50, help="average tweets per second")
+    parser.add_argument("--burst-size", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0.1, help="seconds per lookup")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="seconds per message")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--send-concurrency", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            stream = [json.loads(line) for line in f if line.strip()]
+    else:
+        stream = synthetic_stream(args.tweets, args.authors, args.media_count, args.seed)
+
+    if args.write:
+        with open(args.write, "w") as f:
+            f.writelines(json.dumps(line) + "\n" for line in stream)
+        return
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    results = asyncio.run(replay(args, stream))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(
+        f"{results['tweets']} tweets, {results['messages']} messages and {results['files']} "
+        f"files in {results['seconds']:.2f}s ({results['lookups']} lookups, "
+        f"{results['media_mb']:.1f}MB of media)"
+    )
+    print(
+        f"throughput   {results['tweets_per_second']:.1f} tweets/s, "
+        f"{results['messages_per_second']:.1f} messages/s"
+    )
+    print(f"latency      p50 {results['p50'] * 1000:.0f}ms, p99 {results['p99'] * 1000:.0f}ms")
+    print(f"peak rss     {results['peak_rss_mb']:.0f}MB")
+    stages = ", ".join(
+        f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in results["stages"].items()
+    )
+    print(f"median stage {stages}")
+
+
+if __name__ == "__main__":
+    main()
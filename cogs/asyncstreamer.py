@@ -1,5 +1,7 @@
 import asyncio
 import sys
+import time
+from typing import Optional
 
 import discord
 from discord.ext import commands, tasks
@@ -7,8 +9,10 @@ from loguru import logger
 from tweepy import StreamRule, Tweet
 from tweepy.asynchronous import AsyncClient, AsyncStreamingClient
 
-from modules import queries
+from modules import metrics, rules, tracing
+from modules.dispatch import Dispatcher
 from modules.siniara import Siniara
+from modules.tracing import Trace
 from modules.twitter import TwitterRenderer
 
 
@@ -16,46 +20,76 @@ class RunForeverClient(AsyncStreamingClient):
     def __init__(self, bot, **kwargs):
         self.bot: "Siniara" = bot
         self.twitter_renderer = TwitterRenderer(self.bot)
+        self.dispatcher = Dispatcher(
+            self.send_to_channels,
+            workers=self.bot.config.dispatch_workers,
+            queue_size=self.bot.config.dispatch_queue_size,
+            name="tweet dispatch",
+        )
+        metrics.DISPATCH_IN_FLIGHT.set_function(lambda: self.dispatcher.in_flight)
+        metrics.DISPATCH_QUEUED.set_function(lambda: self.dispatcher.queue.qsize())
+        self.connected_once = False
         super().__init__(**kwargs)
 
     def run_forever(self) -> asyncio.Task:
+        self.dispatcher.start()
+
         async def task():
             while True:
-                await self.filter(tweet_fields=["author_id"])
+                await self.filter(tweet_fields=["author_id", "created_at"])
                 if sys.exc_info()[0] == KeyboardInterrupt:
                     break
 
         return asyncio.create_task(task())
 
-    async def on_tweet(self, tweet: Tweet) -> None:
-        asyncio.ensure_future(self.send_to_channels(tweet))
-
-    async def send_to_channels(self, tweet: Tweet):
-        channel_ids = await queries.get_channels(self.bot.db, tweet.author_id)
-        if not channel_ids:
-            logger.warning(f"No channel ids found for user id {tweet.author_id} {tweet}")
-            return
-
-        channels = []
-        for channel_id in channel_ids:
-            channel = self.bot.get_channel(channel_id)
-            if channel:
-                channels.append(channel)
-            else:
-                logger.warning(
-                    f"Could not find channel with id {channel_id}, adding to deletion list"
-                )
-                self.bot.deletion_list.add((channel_id, tweet.author_id))
+    async def on_connect(self):
+        if self.connected_once:
+            metrics.STREAM_RECONNECTS.inc()
+        self.connected_once = True
+        await super().on_connect()
 
-        if channels:
-            await self.twitter_renderer.send_tweet(tweet.id, channels)
+    async def on_tweet(self, tweet: Tweet) -> None:
+        metrics.TWEETS_RECEIVED.inc()
+        await self.dispatcher.put((tweet, Trace(tweet.id, tweet.created_at)))
+
+    async def send_to_channels(self, item: tuple[Tweet, Trace]):
+        tweet, trace = item
+        trace.add("queued", time.perf_counter() - trace.received_at)
+        with self.bot.tracer.activate(trace):
+            with tracing.span("route"):
+                channel_ids = self.bot.routing.get_channels(tweet.author_id)
+            if not channel_ids:
+                logger.warning(f"No channel ids found for user id {tweet.author_id} {tweet}")
+                return
+
+            channels = []
+            for channel_id in channel_ids:
+                channel = self.bot.get_channel(channel_id)
+                if channel:
+                    channels.append(channel)
+                else:
+                    logger.warning(
+                        f"Could not find channel with id {channel_id}, adding to deletion queue"
+                    )
+                    self.bot.reaper.queue(channel_id, tweet.author_id)
+
+            if channels:
+                await self.twitter_renderer.send_tweet(tweet.id, channels)
+                metrics.TWEETS_DISPATCHED.inc()
 
 
 class Streamer(commands.Cog):
-    NO_RETWEETS = " -is:retweet"
+    NO_RETWEETS = rules.NO_RETWEETS
+    # follow changes are applied once there have been none for FOLLOW_CHANGE_DEBOUNCE seconds,
+    # but no later than FOLLOW_CHANGE_MAX_DELAY seconds after the first one
+    FOLLOW_CHANGE_DEBOUNCE = 3
+    FOLLOW_CHANGE_MAX_DELAY = 15
 
     def __init__(self, bot):
         self.bot: "Siniara" = bot
+        self.sync_lock = asyncio.Lock()
+        self.follows_changed_at = 0.0
+        self.follow_change_task: Optional[asyncio.Task] = None
 
     async def cog_load(self):
         self.api = AsyncClient(
@@ -66,50 +100,72 @@ class Streamer(commands.Cog):
             self.bot,
             bearer_token=self.bot.config.twitter_bearer_token,
         )
+        self.rules = rules.RuleManager(self.stream, self.bot.config.rule_packing)
+        await self.bot.routing.load()
         self.stream.run_forever()
         self.refresh_loop.start()
         self.status_loop.start()
+        self.reconcile_loop.start()
 
     def rule_builder(self, users: list[str]) -> list[StreamRule]:
-        if len(users) == 0:
-            return []
-
-        rules = []
-        rule_value = "from:" + str(users[0])
-        for user in users[1:]:
-            addition = " OR from:" + str(user)
-            if len(rule_value + addition + self.NO_RETWEETS) <= 510:
-                rule_value += addition
-            else:
-                rules.append(f"({rule_value}){self.NO_RETWEETS}")
-                rule_value = "from:" + str(user)
-        if rule_value:
-            rules.append(f"({rule_value}){self.NO_RETWEETS}")
+        packer = rules.PACKERS[self.bot.config.rule_packing]
+        return [StreamRule(rules.rule_value(group)) for group in packer(users)]
 
-        return [StreamRule(value) for value in rules]
-
-    def deconstruct_rules(self, rules: list[StreamRule]) -> list[str]:
+    def deconstruct_rules(self, stream_rules: list[StreamRule]) -> list[str]:
         usernames = []
-        for rule in rules:
-            value = rule.value.removesuffix(self.NO_RETWEETS).strip("()")
-            usernames += [x.split(":")[1] for x in value.split(" OR ")]
+        for rule in stream_rules:
+            usernames += rules.rule_usernames(rule.value)
         return usernames
 
     async def cog_unload(self):
+        if self.follow_change_task is not None:
+            self.follow_change_task.cancel()
         self.stream.disconnect()
+        await self.stream.dispatcher.drain()
 
     @tasks.loop(minutes=5)
     async def status_loop(self):
         try:
-            followed_users = await queries.get_all_users(self.bot.db)
             await self.bot.change_presence(
-                activity=discord.Activity(name=f"{len(followed_users)} accounts", type=3)
+                activity=discord.Activity(name=f"{len(self.bot.routing)} accounts", type=3)
             )
         except Exception as e:
             logger.error("Unhandled exception in status loop")
             logger.error(e)
 
-    @tasks.loop(minutes=1)
+    @commands.Cog.listener()
+    async def on_follows_changed(self):
+        self.follows_changed_at = time.monotonic()
+        if self.follow_change_task is None or self.follow_change_task.done():
+            self.follow_change_task = asyncio.create_task(self.apply_follow_changes())
+
+    async def apply_follow_changes(self):
+        """Coalesce bursts of follow changes into a single rule update."""
+        first_change = self.follows_changed_at
+        while True:
+            deadline = min(
+                self.follows_changed_at + self.FOLLOW_CHANGE_DEBOUNCE,
+                first_change + self.FOLLOW_CHANGE_MAX_DELAY,
+            )
+            if time.monotonic() < deadline:
+                await asyncio.sleep(deadline - time.monotonic())
+                continue
+
+            applied_at = time.monotonic()
+            try:
+                await self.check_for_filter_changes()
+            except Exception as e:
+                logger.error("Unhandled exception while applying follow changes")
+                logger.error(e)
+                return
+
+            if self.follows_changed_at < applied_at:
+                return
+            # more changes came in while we were applying, go again
+            first_change = self.follows_changed_at
+
+    # follow changes are applied as they happen, this is only a safety net
+    @tasks.loop(minutes=15)
     async def refresh_loop(self):
         try:
             await self.check_for_filter_changes()
@@ -117,28 +173,35 @@ class Streamer(commands.Cog):
             logger.error("Unhandled exception in refresh loop")
             logger.error(e)
 
+    @tasks.loop(minutes=30)
+    async def reconcile_loop(self):
+        try:
+            await self.bot.routing.reconcile()
+            # pick up any rule changes made outside of the bot on the next refresh
+            self.rules.loaded = False
+        except Exception as e:
+            logger.error("Unhandled exception in reconcile loop")
+            logger.error(e)
+
     @refresh_loop.before_loop
     @status_loop.before_loop
+    @reconcile_loop.before_loop
     async def wait_for_ready(self):
         await self.bot.wait_until_ready()
 
-    async def replace_rules(self, current_rules: list[StreamRule], new_rules: list[StreamRule]):
-        if current_rules:
-            await self.stream.delete_rules([r.id for r in current_rules])
-        if new_rules:
-            response = await self.stream.add_rules(new_rules)
-            if response.errors:  # type: ignore
-                logger.error(response.errors)  # type: ignore
-            logger.info(f"Added new ruleset {new_rules}")
+    def followed_usernames(self) -> list[str]:
+        usernames = []
+        for user_id in self.bot.routing.user_ids():
+            username = self.bot.twitter_users.get_username(user_id)
+            if username is None:
+                logger.warning(f"Followed twitter user {user_id} has no known username")
+            else:
+                usernames.append(username)
+        return usernames
 
     async def check_for_filter_changes(self):
-        current_rules = await self.stream.get_rules()
-        current_rules = current_rules.data or []  # type: ignore
-        followed_users = await queries.get_all_users(self.bot.db)
-        current_users = self.deconstruct_rules(current_rules)
-        if set(followed_users) != set(current_users):
-            new_rules = self.rule_builder(followed_users)
-            await self.replace_rules(current_rules, new_rules)
+        async with self.sync_lock:
+            await self.rules.sync(self.followed_usernames())
 
 
 async def setup(bot: Siniara):
@@ -19,8 +19,7 @@ class Commands(commands.Cog):
     @app_commands.command()
     async def info(self, interaction: discord.Interaction):
         """Get information about the bot."""
-        userlist = await queries.get_all_users(self.bot.db)
-        followcount = len(set(userlist))
+        followcount = len(self.bot.routing)
         content = discord.Embed(title="Siniara v6", colour=self.bot.twitter_blue)
         content.description = (
             f"Bot for fetching new media content from twitter, "
@@ -83,6 +82,68 @@ class Commands(commands.Cog):
         data = await self.bot.db.execute(statement)
         await ctx.send(f"```py\n{data}\n```")
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def querystats(
+        self, ctx: commands.Context, action: typing.Optional[typing.Literal["reset"]] = None
+    ):
+        """Show which database queries take the most time."""
+        if action == "reset":
+            self.bot.db.stats.clear()
+            return await ctx.send("Query stats cleared")
+
+        stats = sorted(self.bot.db.stats.items(), key=lambda x: x[1].total_time, reverse=True)
+        content = discord.Embed(
+            title=f"Query stats for {sum(s.calls for _, s in stats)} queries",
+            color=self.bot.twitter_blue,
+        )
+        rows = []
+        for name, s in stats:
+            rows.append(
+                f"**{name}** `{s.calls}` calls, `{s.total_time / 1000:.2f}s` total"
+                + (f", `{s.errors}` errors" if s.errors else "")
+                + f"\n> avg `{s.total_time / s.calls:.1f}ms` p50 `{s.percentile(50):.1f}ms` "
+                f"p99 `{s.percentile(99):.1f}ms` max `{s.max_time:.1f}ms` "
+                f"rows `{s.rows / s.calls:.1f}`"
+            )
+
+        if not rows:
+            return await ctx.send("No queries recorded yet")
+
+        db = self.bot.db
+        if db.pool is not None:
+            content.set_footer(
+                text=f"Pool: {db.pool.size - db.pool.freesize}/{db.pool.maxsize} in use, "
+                f"exhausted {db.exhausted} times, {db.acquire_timeouts} acquire timeouts, "
+                f"{db.dead_connections} dead connections dropped"
+            )
+
+        await RowPaginator(content, rows, per_page=8).run(ctx)
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def tracestats(self, ctx: commands.Context):
+        """Show how long each stage of sending a streamed tweet takes."""
+        tracer = self.bot.tracer
+        content = discord.Embed(
+            title=f"Latest {len(tracer.samples['total'])} streamed tweets",
+            color=self.bot.twitter_blue,
+        )
+        rows = []
+        for stage, samples in tracer.samples.items():
+            if not samples:
+                continue
+            p50, p90, p99 = tracer.percentiles(stage)
+            rows.append(
+                f"**{stage}** `{len(samples)}` samples\n> p50 `{p50:.2f}s` p90 `{p90:.2f}s` "
+                f"p99 `{p99:.2f}s` max `{max(samples):.2f}s`"
+            )
+
+        if not rows:
+            return await ctx.send("No tweets traced yet")
+
+        await RowPaginator(content, rows).run(ctx)
+
     @commands.command()
     @commands.is_owner()
     async def unlock(self, ctx: commands.Context, guild: typing.Optional[discord.Guild] = None):
@@ -1,4 +1,6 @@
+import asyncio
 import re
+import time
 import typing
 
 import arrow
@@ -14,46 +16,55 @@ from modules.ui import Confirm, RowPaginator, SettingsMenu, followup_or_send
 
 
 class Twitter(commands.Cog):
+    PURGE_CONCURRENCY = 4
+    PROGRESS_INTERVAL = 2
+
     def __init__(self, bot):
         self.bot: Siniara = bot
         self.twitter_renderer = TwitterRenderer(self.bot)
 
-    async def follow(self, channel, user_id, username, timestamp):
-        await self.bot.db.execute(
-            """
-            INSERT INTO twitter_user VALUES (%s, %s)
-            ON DUPLICATE KEY UPDATE username = %s
-            """,
-            user_id,
-            username,
-            username,
-        )
-        await self.bot.db.execute(
-            "INSERT INTO follow VALUES (%s, %s, %s, %s)",
-            channel.id,
-            channel.guild.id,
-            user_id,
-            timestamp,
-        )
+    async def cog_load(self):
+        self.user_refresh_loop.start()
+        self.bot.reaper.start()
 
-    async def unfollow(self, channel_id, user_id):
-        await self.bot.db.execute(
-            "DELETE FROM follow WHERE twitter_user_id = %s AND channel_id = %s",
-            user_id,
-            channel_id,
-        )
+    async def cog_unload(self):
+        self.user_refresh_loop.cancel()
+        self.bot.reaper.stop()
+
+    async def follow(self, channel, users: list[tuple[int, str]], timestamp):
+        async with self.bot.db.transaction() as cur:
+            await self.bot.twitter_users.put(users, cur)
+            await cur.executemany(
+                "INSERT INTO follow VALUES (%s, %s, %s, %s)",
+                [(channel.id, channel.guild.id, user_id, timestamp) for user_id, _ in users],
+            )
+            await queries.refresh_follow_counts(cur, [channel.guild.id])
+        for user_id, _ in users:
+            self.bot.routing.add(channel.id, user_id)
+        self.bot.dispatch("follows_changed")
+
+    async def unfollow(self, channel, user_ids: list[int]):
+        async with self.bot.db.transaction() as cur:
+            await cur.execute(
+                "DELETE FROM follow WHERE channel_id = %s AND twitter_user_id IN %s",
+                (channel.id, user_ids),
+            )
+            await queries.refresh_follow_counts(cur, [channel.guild.id])
+        for user_id in user_ids:
+            self.bot.routing.remove(channel.id, user_id)
+        self.bot.dispatch("follows_changed")
 
-    @tasks.loop(hours=12)
-    async def purge_loop(self):
+    @tasks.loop(minutes=15)
+    async def user_refresh_loop(self):
         try:
-            for channel_id, user_id in self.bot.deletion_list:
-                await self.unfollow(channel_id, user_id)
-                self.bot.deletion_list.remove((channel_id, user_id))
+            renamed = await self.bot.twitter_users.refresh(self.bot.routing.user_ids())
+            if renamed:
+                self.bot.dispatch("follows_changed")
         except Exception as e:
-            logger.error("Unhandled exception in purge loop")
+            logger.error("Unhandled exception in user refresh loop")
             logger.error(e)
 
-    @purge_loop.before_loop
+    @user_refresh_loop.before_loop
     async def wait_for_ready(self):
         await self.bot.wait_until_ready()
 
@@ -68,41 +79,46 @@ class Twitter(commands.Cog):
         """Add users to the follow list."""
         rows = []
         time_now = arrow.now().datetime
-        current_users = await self.bot.db.execute(
-            "SELECT twitter_user_id FROM follow WHERE channel_id = %s", channel.id
+        current_users = set(
+            await self.bot.db.execute(
+                "SELECT twitter_user_id FROM follow WHERE channel_id = %s",
+                channel.id,
+                as_list=True,
+            )
         )
         guild_follow_current, guild_follow_limit = await queries.get_follow_limit(
             self.bot.db, channel.guild.id
         )
-        successes = 0
-        for username in usernames.split():
-            username = username.strip("@")
-            status = None
-            user = None
-            try:
-                twitter_user = await self.bot.tweepy.get_user(username=username)
-                user = twitter_user.data  # type: ignore
-            except Exception as e:
-                status = f":x: Error {e}"
+        names = [username.strip("@") for username in usernames.split()]
+        users, errors = await self.bot.twitter_users.resolve(names)
+        new_follows = []
+        for username in names:
+            user = users.get(username.lower())
+            if user is None:
+                status = f":x: Error {errors.get(username.lower(), 'User not found')}"
             else:
-                if (user.id,) in current_users:
+                user_id, username = user
+                if user_id in current_users:
                     status = ":x: User already being followed on this channel"
+                elif guild_follow_current >= guild_follow_limit:
+                    status = f":lock: Guild follow count limit reached ({guild_follow_limit})"
                 else:
-                    if guild_follow_current >= guild_follow_limit:
-                        status = f":lock: Guild follow count limit reached ({guild_follow_limit})"
-                    else:
-                        await self.follow(channel, user.id, user.username, time_now)
-                        status = ":white_check_mark: Success"
-                        successes += 1
-                        guild_follow_current += 1
+                    new_follows.append(user)
+                    current_users.add(user_id)
+                    status = ":white_check_mark: Success"
+                    guild_follow_current += 1
 
-            rows.append(f"**@{user.username if user else username}** {status}")
+            rows.append(f"**@{username}** {status}")
+
+        if new_follows:
+            await self.follow(channel, new_follows, time_now)
+        successes = len(new_follows)
 
         content = discord.Embed(
             title=f":notepad_spiral: Added {successes}/{len(usernames.split())} users to {channel.name}",
             color=self.bot.twitter_blue,
         )
-        content.set_footer(text="Changes will take effect within a minute")
+        content.set_footer(text="Changes will take effect in a few seconds")
         await RowPaginator(content, rows).run(interaction)
 
     @app_commands.command(name="remove")
@@ -115,42 +131,38 @@ class Twitter(commands.Cog):
     ):
         """Remove users from the follow list."""
         rows = []
-        current_users = await self.bot.db.execute(
-            "SELECT twitter_user_id FROM follow WHERE channel_id = %s", channel.id
+        current_users = set(
+            await self.bot.db.execute(
+                "SELECT twitter_user_id FROM follow WHERE channel_id = %s",
+                channel.id,
+                as_list=True,
+            )
         )
-        successes = 0
-        for username in usernames.split():
-            username = username.strip("@")
-            status = None
-            try:
-                twitter_user = await self.bot.tweepy.get_user(username=username)
-                user_id = twitter_user.data.id  # type: ignore
-            except Exception as e:
-                # user not found, maybe changed username
-                # try finding username from cache
-                user_id = await self.bot.db.execute(
-                    "SELECT user_id FROM twitter_user WHERE username = %s", username
-                )
-                if user_id:
-                    user_id = user_id[0][0]
-                else:
-                    status = f":x: Error {e.args[0][0]['code']}: {e.args[0][0]['message']}"
-
-            if status is None:
-                if (user_id,) not in current_users:
-                    status = ":x: User is not being followed on this channel"
-                else:
-                    await self.unfollow(channel.id, user_id)
-                    status = ":white_check_mark: Success"
-                    successes += 1
+        names = [username.strip("@") for username in usernames.split()]
+        users, errors = await self.bot.twitter_users.resolve(names)
+        to_unfollow = []
+        for username in names:
+            user = users.get(username.lower())
+            if user is None:
+                status = f":x: Error {errors.get(username.lower(), 'User not found')}"
+            elif user[0] not in current_users:
+                status = ":x: User is not being followed on this channel"
+            else:
+                to_unfollow.append(user[0])
+                current_users.remove(user[0])
+                status = ":white_check_mark: Success"
 
             rows.append(f"**@{username}** {status}")
 
+        if to_unfollow:
+            await self.unfollow(channel, to_unfollow)
+        successes = len(to_unfollow)
+
         content = discord.Embed(
             title=f":notepad_spiral: Removed {successes}/{len(usernames.split())} users from {channel.name}",
             color=self.bot.twitter_blue,
         )
-        content.set_footer(text="Changes will take effect within a minute")
+        content.set_footer(text="Changes will take effect in a few seconds")
         await RowPaginator(content, rows).run(interaction)
 
     @app_commands.command(name="list")
@@ -160,15 +172,8 @@ class Twitter(commands.Cog):
         channel: typing.Optional[discord.TextChannel] = None,
     ):
         """List all followed accounts on server or channel"""
-        data = await self.bot.db.execute(
-            """
-            SELECT twitter_user.username, channel_id, added_on
-            FROM follow LEFT JOIN twitter_user
-            ON twitter_user.user_id = follow.twitter_user_id WHERE follow.guild_id = %s
-            """
-            + (f" AND channel_id = {channel.id}" if channel is not None else "")
-            + " ORDER BY channel_id, added_on DESC",
-            interaction.guild_id,
+        data = await queries.list_follows(
+            self.bot.db, interaction.guild_id, channel.id if channel is not None else None
         )
         content = discord.Embed(title="Followed twitter users", color=self.bot.twitter_blue)
         rows = []
@@ -190,7 +195,7 @@ class Twitter(commands.Cog):
         self, interaction: discord.Interaction, channel: typing.Optional[discord.TextChannel]
     ):
         """Configure the tweet filtering settings"""
-        await SettingsMenu(self.bot).render(interaction)
+        await SettingsMenu(self.bot).run(interaction)
 
     rule_group = app_commands.Group(name="rule", description="Add a config rule")
 
@@ -207,18 +212,14 @@ class Twitter(commands.Cog):
     @rule_group.command(name="user")
     async def rule_user(self, interaction: discord.Interaction, username: str, value: bool):
         """If set to True, only tweets with media will be sent from this twitter account"""
-        user_id = await self.bot.db.execute(
-            """
-            SELECT twitter_user.user_id
-            FROM follow RIGHT JOIN twitter_user
-            ON twitter_user.user_id = follow.twitter_user_id
-            WHERE twitter_user.username = %s AND guild_id = %s""",
-            username,
-            interaction.guild_id,
-            one_value=True,
-        )
-        if not user_id:
-            await interaction.response.send_message(
+        username = username.strip("@")
+        user_id = self.bot.twitter_users.get_user_id(username)
+        if user_id is not None:
+            followed = await queries.is_followed_in_guild(
+                self.bot.db, user_id, interaction.guild_id
+            )
+        if user_id is None or not followed:
+            return await interaction.response.send_message(
                 f':x: No channel on this server is following "@{username}"', ephemeral=True
             )
 
@@ -259,6 +260,11 @@ class Twitter(commands.Cog):
 
         results = []
         await interaction.response.defer()
+        # look every tweet up at once so they get fetched in a single batch
+        await asyncio.gather(
+            *(self.bot.tweet_loader.get(tweet_id) for tweet_id in tweet_ids),
+            return_exceptions=True,
+        )
         for tweet_id in tweet_ids:
             try:
                 if channel is None and isinstance(interaction.channel, SendableChannel):
@@ -292,45 +298,53 @@ class Twitter(commands.Cog):
     @commands.is_owner()
     async def purge(self, ctx: commands.Context):
         """Remove all follows from unavailable guilds and channels."""
-        data = await self.bot.db.execute(
-            """
-            SELECT channel_id, guild_id, twitter_user_id, username
-            FROM follow
-            JOIN twitter_user
-            ON twitter_user_id=user_id
-            """
-        )
+        data = await self.bot.db.execute("SELECT channel_id, guild_id, twitter_user_id FROM follow")
         actions = []
-        guilds_to_delete = []
-        channels_to_delete = []
+        guilds_to_delete = set()
+        channels_to_delete = set()
         users_to_delete = []
         twitter_usernames = {}
         usernames_to_change = []
-        for channel_id, guild_id, twitter_uid, username in data:
+        follows_to_delete = []
+        changed_guilds = set()
+        guilds_by_user = {}
+        for channel_id, guild_id, twitter_uid in data:
+            guilds_by_user.setdefault(twitter_uid, set()).add(guild_id)
             if self.bot.get_guild(guild_id) is None:
-                actions.append(f"Could not find guild with id: [{guild_id}]")
-                guilds_to_delete.append(guild_id)
+                if guild_id not in guilds_to_delete:
+                    actions.append(f"Could not find guild with id: [{guild_id}]")
+                    guilds_to_delete.add(guild_id)
+                follows_to_delete.append((channel_id, twitter_uid))
+                changed_guilds.add(guild_id)
             elif self.bot.get_channel(channel_id) is None:
-                actions.append(f"Could not find channel with id: [{channel_id}]")
-                channels_to_delete.append(channel_id)
+                if channel_id not in channels_to_delete:
+                    actions.append(f"Could not find channel with id: [{channel_id}]")
+                    channels_to_delete.add(channel_id)
+                follows_to_delete.append((channel_id, twitter_uid))
+                changed_guilds.add(guild_id)
             else:
-                twitter_usernames[twitter_uid] = username
+                twitter_usernames[twitter_uid] = self.bot.twitter_users.get_username(twitter_uid)
 
         uids = list(twitter_usernames.keys())
-
-        for uids_chunk in [uids[i : i + 100] for i in range(0, len(uids), 100)]:
-            userdata = await self.bot.tweepy.get_users(ids=uids_chunk)
-            if userdata.errors:  # type: ignore
-                for error in userdata.errors:  # type: ignore
-                    actions.append(error["detail"])
-                    users_to_delete.append(int(error["value"]))
-            if userdata.data:  # type: ignore
-                for user in userdata.data:  # type: ignore
-                    if twitter_usernames[user.id] != user.username:
-                        actions.append(
-                            f"User has changed username from @{twitter_usernames[user.id]} to @{user.username}"
-                        )
-                        usernames_to_change.append((user.id, user.username))
+        chunks = [uids[i : i + 100] for i in range(0, len(uids), 100)]
+        progress = await ctx.send(f":hourglass: Checking {len(uids)} twitter users...")
+        responses = await self.lookup_users_concurrently(chunks, progress)
+
+        for userdata in responses:
+            for error in userdata.errors:  # type: ignore
+                actions.append(error["detail"])
+                users_to_delete.append(int(error["value"]))
+                changed_guilds.update(guilds_by_user[int(error["value"])])
+            for user in userdata.data or []:  # type: ignore
+                previous = twitter_usernames[user.id]
+                if previous is None:
+                    actions.append(f"Username of user [{user.id}] is @{user.username}")
+                    usernames_to_change.append((user.id, user.username))
+                elif previous != user.username:
+                    actions.append(
+                        f"User has changed username from @{previous} to @{user.username}"
+                    )
+                    usernames_to_change.append((user.id, user.username))
 
         if not actions:
             return await ctx.send("There is nothing to do.")
@@ -343,24 +357,52 @@ class Twitter(commands.Cog):
         view = await Confirm("Do you want to continue?").run(ctx)
         await view.wait()
         if view.value:
-            if guilds_to_delete:
-                await self.bot.db.execute(
-                    "DELETE FROM follow WHERE guild_id IN %s", guilds_to_delete
-                )
-            if channels_to_delete:
-                await self.bot.db.execute(
-                    "DELETE FROM follow WHERE channel_id IN %s", channels_to_delete
-                )
-            if users_to_delete:
-                await self.bot.db.execute(
-                    "DELETE FROM twitter_user WHERE user_id IN %s", users_to_delete
-                )
-            for uid, new_name in usernames_to_change:
-                await self.bot.db.execute(
-                    "UPDATE twitter_user SET username = %s WHERE user_id = %s", new_name, uid
-                )
+            async with self.bot.db.transaction() as cur:
+                if guilds_to_delete:
+                    await cur.execute(
+                        "DELETE FROM follow WHERE guild_id IN %s", (list(guilds_to_delete),)
+                    )
+                if channels_to_delete:
+                    await cur.execute(
+                        "DELETE FROM follow WHERE channel_id IN %s", (list(channels_to_delete),)
+                    )
+                if users_to_delete:
+                    await cur.execute(
+                        "DELETE FROM twitter_user WHERE user_id IN %s", (users_to_delete,)
+                    )
+                await self.bot.twitter_users.put(usernames_to_change, cur)
+                await queries.refresh_follow_counts(cur, changed_guilds)
+
+            self.bot.twitter_users.forget(users_to_delete)
+            for channel_id, twitter_uid in follows_to_delete:
+                self.bot.routing.remove(channel_id, twitter_uid)
+            for twitter_uid in users_to_delete:
+                self.bot.routing.remove_user(twitter_uid)
+            self.bot.dispatch("follows_changed")
             await ctx.send("Purge complete!")
 
+    async def lookup_users_concurrently(self, chunks: list[list[int]], progress: discord.Message):
+        """Run get_users for every chunk of ids, a few at a time within the lookup rate limit."""
+        semaphore = asyncio.Semaphore(self.PURGE_CONCURRENCY)
+        done = 0
+        last_update = time.monotonic()
+
+        async def lookup(chunk):
+            nonlocal done, last_update
+            async with semaphore:
+                await self.bot.twitter_users.lookups.acquire()
+                response = await self.bot.tweepy.get_users(ids=chunk)
+
+            done += 1
+            if done == len(chunks) or time.monotonic() - last_update > self.PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await progress.edit(
+                    content=f":hourglass: Checked {done}/{len(chunks)} batches of twitter users"
+                )
+            return response
+
+        return await asyncio.gather(*(lookup(chunk) for chunk in chunks))
+
 
 async def setup(bot: Siniara):
     await bot.add_cog(Twitter(bot))
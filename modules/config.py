@@ -17,3 +17,16 @@ class Config:
             "password": os.environ["DB_PASS"],
             "db": os.environ["DB_NAME"],
         }
+        self.db_pool_min = int(os.environ.get("DB_POOL_MIN", 2))
+        self.db_pool_max = int(os.environ.get("DB_POOL_MAX", 20))
+        self.db_pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 3600))
+        self.db_acquire_timeout = float(os.environ.get("DB_ACQUIRE_TIMEOUT", 10))
+        self.media_cache_dir = os.environ.get("MEDIA_CACHE_DIR", "cache/media")
+        self.media_cache_size = int(os.environ.get("MEDIA_CACHE_SIZE_MB", 1024)) * 1024**2
+        self.dispatch_workers = int(os.environ.get("DISPATCH_WORKERS", 8))
+        self.dispatch_queue_size = int(os.environ.get("DISPATCH_QUEUE_SIZE", 1000))
+        self.send_concurrency = int(os.environ.get("SEND_CONCURRENCY", 25))
+        self.rule_packing = os.environ.get("RULE_PACKING", "ffd")
+        self.slow_query_ms = int(os.environ.get("SLOW_QUERY_MS", 250))
+        self.metrics_host = os.environ.get("METRICS_HOST", "127.0.0.1")
+        self.metrics_port = int(os.environ.get("METRICS_PORT", 9191))
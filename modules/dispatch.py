@@ -0,0 +1,94 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from loguru import logger
+
+from modules import metrics
+
+T = TypeVar("T")
+
+
+class Dispatcher(Generic[T]):
+    """
+    Bounded queue of items processed by a fixed number of worker tasks.
+    Putting into a full queue waits for a free slot, which pushes back on the producer.
+    """
+
+    SLOW_THRESHOLD = 10
+
+    def __init__(
+        self,
+        handler: Callable[[T], Awaitable[None]],
+        workers: int,
+        queue_size: int,
+        name: str = "dispatch",
+    ):
+        self.handler = handler
+        self.worker_count = workers
+        self.name = name
+        self.queue: asyncio.Queue[tuple[float, T]] = asyncio.Queue(maxsize=queue_size)
+        self.workers: list[asyncio.Task] = []
+        self.in_flight = 0
+        self.closed = False
+        # warn once per backlog instead of for every item put into a full queue
+        self.backlogged = False
+        self.wait_seconds = metrics.DISPATCH_WAIT_SECONDS.labels(name)
+        self.handle_seconds = metrics.DISPATCH_HANDLE_SECONDS.labels(name)
+
+    def start(self):
+        self.closed = False
+        self.workers = [
+            asyncio.create_task(self.worker(), name=f"{self.name}-worker-{i}")
+            for i in range(self.worker_count)
+        ]
+
+    async def put(self, item: T):
+        if self.closed:
+            logger.warning(f"{self.name} is closed, dropping {item}")
+            return
+
+        if not self.queue.full():
+            self.backlogged = False
+        elif not self.backlogged:
+            self.backlogged = True
+            logger.warning(f"{self.name} queue is full ({self.queue.maxsize}), waiting for a slot")
+        await self.queue.put((time.monotonic(), item))
+
+    async def worker(self):
+        while True:
+            enqueued_at, item = await self.queue.get()
+            started_at = time.monotonic()
+            self.in_flight += 1
+            try:
+                await self.handler(item)
+            except Exception as e:
+                logger.exception(f"Unhandled exception in {self.name} while handling {item}: {e}")
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+            finished_at = time.monotonic()
+            queued = started_at - enqueued_at
+            handled = finished_at - started_at
+            self.wait_seconds.observe(queued)
+            self.handle_seconds.observe(handled)
+            if queued + handled > self.SLOW_THRESHOLD:
+                logger.warning(
+                    f"{self.name} took {queued + handled:.2f}s for {item} "
+                    f"(queued {queued:.2f}s, handled {handled:.2f}s)"
+                )
+
+    async def drain(self, timeout: float = 10):
+        """Stop accepting new items and wait for the queued ones to finish."""
+        self.closed = True
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.name} drain timed out with {self.queue.qsize()} items left")
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        logger.info(f"{self.name} drained")
@@ -0,0 +1,148 @@
+import re
+import time
+from typing import Optional
+
+from loguru import logger
+
+from modules.scheduler import RateLimiter
+
+USERNAME_PATTERN = re.compile(r"\w{1,15}", re.ASCII)
+
+
+class TwitterUserCache:
+    """
+    Two-way mapping between twitter usernames and user ids, loaded from the twitter_user
+    table on startup and written through to it. Every entry remembers when the twitter api
+    last confirmed it, so the stalest ones can be refreshed in the background.
+    """
+
+    STALE_AFTER = 24 * 60 * 60
+    REFRESH_BATCH = 500
+
+    def __init__(self, bot):
+        self.bot = bot
+        # the users lookup endpoints allow 300 requests per 15 minutes
+        self.lookups = RateLimiter(300, 15 * 60)
+        self.usernames: dict[int, str] = {}
+        self.user_ids: dict[str, int] = {}
+        # 0 means loaded from the database and not confirmed since
+        self.refreshed_at: dict[int, float] = {}
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def get_username(self, user_id: int) -> Optional[str]:
+        return self.usernames.get(user_id)
+
+    def get_user_id(self, username: str) -> Optional[int]:
+        return self.user_ids.get(username.lower())
+
+    def _set(self, user_id: int, username: str, refreshed_at: float):
+        old_username = self.usernames.get(user_id)
+        if old_username is not None and self.user_ids.get(old_username.lower()) == user_id:
+            del self.user_ids[old_username.lower()]
+        self.usernames[user_id] = username
+        self.user_ids[username.lower()] = user_id
+        self.refreshed_at[user_id] = refreshed_at
+
+    async def load(self):
+        data = await self.bot.db.execute("SELECT user_id, username FROM twitter_user")
+        for user_id, username in data:
+            self._set(user_id, username, 0)
+        logger.info(f"Loaded {len(self)} twitter users")
+
+    async def put(self, users: list[tuple[int, str]], cursor=None):
+        """Remember users confirmed by the twitter api, writing them to the database as well."""
+        if not users:
+            return
+
+        statement = """
+            INSERT INTO twitter_user VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE username = VALUES(username)
+            """
+        if cursor is None:
+            await self.bot.db.executemany(statement, users)
+        else:
+            await cursor.executemany(statement, users)
+
+        now = time.time()
+        for user_id, username in users:
+            self._set(user_id, username, now)
+
+    def forget(self, user_ids: list[int]):
+        for user_id in user_ids:
+            username = self.usernames.pop(user_id, None)
+            self.refreshed_at.pop(user_id, None)
+            if username is not None and self.user_ids.get(username.lower()) == user_id:
+                del self.user_ids[username.lower()]
+
+    async def resolve(
+        self, usernames: list[str]
+    ) -> tuple[dict[str, tuple[int, str]], dict[str, str]]:
+        """
+        Look up twitter users by username, from the cache if we already know them
+        and otherwise from the twitter api in batches of 100.
+        Returns the users and the errors, both by lowercase username.
+        """
+        users = {}
+        errors = {}
+        unknown = {}
+        for username in usernames:
+            key = username.lower()
+            user_id = self.user_ids.get(key)
+            if user_id is not None:
+                users[key] = (user_id, self.usernames[user_id])
+            elif USERNAME_PATTERN.fullmatch(username):
+                unknown[key] = username
+            else:
+                errors[key] = "Invalid username"
+
+        unknown_names = list(unknown.values())
+        for chunk in [unknown_names[i : i + 100] for i in range(0, len(unknown_names), 100)]:
+            try:
+                await self.lookups.acquire()
+                response = await self.bot.tweepy.get_users(usernames=chunk)
+            except Exception as e:
+                for username in chunk:
+                    errors[username.lower()] = str(e)
+                continue
+
+            found = [(user.id, user.username) for user in response.data or []]  # type: ignore
+            await self.put(found)
+            for user_id, username in found:
+                users[username.lower()] = (user_id, username)
+            for error in response.errors:  # type: ignore
+                key = str(error.get("value", "")).lower()
+                errors[key] = error.get("detail", "User not found")
+
+        return users, errors
+
+    async def refresh(self, user_ids: list[int]) -> list[tuple[int, str, str]]:
+        """
+        Confirm the stalest of the given users with the twitter api.
+        Returns the users that have changed their username, as (id, old name, new name).
+        """
+        cutoff = time.time() - self.STALE_AFTER
+        stale = sorted(
+            (uid for uid in user_ids if self.refreshed_at.get(uid, 0) < cutoff),
+            key=lambda uid: self.refreshed_at.get(uid, 0),
+        )[: self.REFRESH_BATCH]
+
+        renamed = []
+        for chunk in [stale[i : i + 100] for i in range(0, len(stale), 100)]:
+            await self.lookups.acquire()
+            response = await self.bot.tweepy.get_users(ids=chunk)
+            # users that could not be found are left for purge to deal with,
+            # but still count as refreshed so they don't hold up the queue
+            now = time.time()
+            for user_id in chunk:
+                self.refreshed_at[user_id] = now
+            for user in response.data or []:  # type: ignore
+                old_username = self.usernames.get(user.id)
+                if old_username != user.username:
+                    renamed.append((user.id, old_username, user.username))
+
+        await self.put([(user_id, new_username) for user_id, _, new_username in renamed])
+        if renamed:
+            logger.info(f"Found {len(renamed)} renamed twitter users: {renamed}")
+        return renamed
@@ -1,69 +1,256 @@
 import asyncio
-from typing import Optional
+import bisect
+import functools
+import math
+import textwrap
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Optional, Union
 import aiomysql
 
 from loguru import logger
 
+from modules import metrics
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, math.inf)
+
+
+@dataclass(frozen=True)
+class Query:
+    """
+    A named sql statement. aiomysql only speaks the text protocol, so there is no server side
+    prepare; the statement is cleaned up once when it's defined and sent as is after that.
+    """
+
+    name: str
+    sql: str
+
+    def __post_init__(self):
+        object.__setattr__(self, "sql", textwrap.dedent(self.sql).strip())
+
+
+@functools.lru_cache(maxsize=256)
+def adhoc_query(sql: str) -> Query:
+    """Name a raw sql string after its first few words."""
+    words = sql.split()
+    name = " ".join(words[:6])
+    if len(words) > 6:
+        name += " ..."
+    return Query(name, sql)
+
+
+class QueryStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, elapsed_ms: float, rows: int, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.rows += max(rows, 0)
+        self.total_time += elapsed_ms
+        self.max_time = max(self.max_time, elapsed_ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, elapsed_ms)] += 1
+
+    def percentile(self, p: float) -> float:
+        """Upper bound of the histogram bucket the given percentile falls in."""
+        target = self.calls * p / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max_time)
+        return self.max_time
+
+
+class TimedCursor:
+    """Cursor wrapper that records the statements executed in a transaction."""
+
+    def __init__(self, db: "MariaDB", cursor: aiomysql.Cursor):
+        self.db = db
+        self.cursor = cursor
+
+    async def execute(self, statement, params=None):
+        return await self.db.run(self.cursor, statement, params)
+
+    async def executemany(self, statement, params):
+        return await self.db.run(self.cursor, statement, params, many=True)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
 
 class MariaDB:
+    MAX_RETRY_DELAY = 60
+    PING_INTERVAL = 60
+
     def __init__(self, bot):
         self.bot = bot
         self.pool: Optional[aiomysql.Pool] = None
+        self.ready = asyncio.Event()
+        self.health_task: Optional[asyncio.Task] = None
+        self.stats: defaultdict[str, QueryStats] = defaultdict(QueryStats)
+        # acquires that had to wait because every connection was in use
+        self.exhausted = 0
+        self.acquire_timeouts = 0
+        self.dead_connections = 0
+        metrics.DB_POOL_IN_USE.set_function(
+            lambda: self.pool.size - self.pool.freesize if self.pool else 0
+        )
+        metrics.DB_POOL_SIZE.set_function(lambda: self.pool.size if self.pool else 0)
 
-    async def wait_for_pool(self):
-        i = 0
-        while self.pool is None and i < 10:
+    async def wait_for_pool(self, timeout=10):
+        if not self.ready.is_set():
             logger.warning("Pool not initialized yet. waiting...")
-            await asyncio.sleep(1)
-            i += 1
-
-        if self.pool is None:
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
             logger.error("Pool wait timeout! ABORTING")
             return False
         return True
 
+    async def get_pool(self) -> aiomysql.Pool:
+        if not self.ready.is_set() and not await self.wait_for_pool():
+            raise Exception("Could not connect to the local MariaDB instance!")
+        return self.pool  # type: ignore
+
     async def initialize_pool(self):
+        config = self.bot.config
+        delay = 1
         while self.pool is None:
             try:
                 self.pool = await aiomysql.create_pool(
-                    **self.bot.config.dbcredentials,
+                    **config.dbcredentials,
+                    minsize=config.db_pool_min,
+                    maxsize=config.db_pool_max,
+                    pool_recycle=config.db_pool_recycle,
                     autocommit=True,
                 )
             except Exception as e:
-                logger.error(e)
-                await asyncio.sleep(1)
-        logger.info("Initialized MariaDB connection pool")
+                logger.error(f"{e}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.MAX_RETRY_DELAY)
+        self.ready.set()
+        self.health_task = asyncio.create_task(self.health_check())
+        logger.info(
+            f"Initialized MariaDB connection pool of {config.db_pool_min}-{config.db_pool_max}"
+        )
 
     async def cleanup(self):
+        self.ready.clear()
+        if self.health_task is not None:
+            self.health_task.cancel()
         if self.pool:
             self.pool.close()
             await self.pool.wait_closed()
         logger.info("Closed MariaDB connection pool")
 
-    async def execute(self, statement, *params, one_row=False, one_value=False, as_list=False):
-        if await self.wait_for_pool() and self.pool:
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(statement, params)
-                    data = await cur.fetchall()
-            if data is None:
-                return ()
-            if data:
-                if one_value:
-                    return data[0][0]
-                if one_row:
-                    return data[0]
-                if as_list:
-                    return [row[0] for row in data]
-                return data
+    async def health_check(self):
+        while True:
+            await asyncio.sleep(self.PING_INTERVAL)
+            try:
+                await self.ping()
+            except Exception as e:
+                logger.error("Unhandled exception in database health check")
+                logger.error(e)
+
+    async def ping(self):
+        """Ping every idle connection, so dead ones are dropped before a query gets them."""
+        pool = await self.get_pool()
+        # released connections go to the back of the queue, so this goes through each once
+        for _ in range(pool.freesize):
+            conn = await pool.acquire()
+            try:
+                await conn.ping(reconnect=False)
+            except Exception as e:
+                self.dead_connections += 1
+                logger.warning(f"Dropping dead database connection: {e}")
+                conn.close()
+            finally:
+                await pool.release(conn)
+
+    @asynccontextmanager
+    async def connection(self):
+        """Acquire a connection from the pool, waiting at most db_acquire_timeout seconds."""
+        pool = await self.get_pool()
+        if pool.freesize == 0 and pool.size >= pool.maxsize:
+            self.exhausted += 1
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self.bot.config.db_acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise Exception(f"All {pool.maxsize} database connections are busy!")
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    async def run(self, cur, statement: Union[Query, str], params, many=False):
+        """Execute a statement on the cursor, recording its latency and the rows it touched."""
+        query = statement if isinstance(statement, Query) else adhoc_query(statement)
+        failed = True
+        started = time.perf_counter()
+        try:
+            if many:
+                result = await cur.executemany(query.sql, params)
+            else:
+                result = await cur.execute(query.sql, params)
+            failed = False
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.stats[query.name].observe(elapsed_ms, cur.rowcount, failed)
+            metrics.DB_QUERY_SECONDS.labels(query.name).observe(elapsed_ms / 1000)
+            if elapsed_ms > self.bot.config.slow_query_ms:
+                logger.warning(f"Slow query {query.name} took {elapsed_ms:.0f}ms")
+
+    async def execute(
+        self,
+        statement: Union[Query, str],
+        *params,
+        one_row=False,
+        one_value=False,
+        as_list=False,
+    ):
+        async with self.connection() as conn:
+            async with conn.cursor() as cur:
+                await self.run(cur, statement, params)
+                data = await cur.fetchall()
+        if data is None:
             return ()
-        raise Exception("Could not connect to the local MariaDB instance!")
+        if data:
+            if one_value:
+                return data[0][0]
+            if one_row:
+                return data[0]
+            if as_list:
+                return [row[0] for row in data]
+            return data
+        return ()
 
-    async def executemany(self, statement, params):
-        if await self.wait_for_pool() and self.pool:
-            async with self.pool.acquire() as conn:
+    async def executemany(self, statement: Union[Query, str], params):
+        async with self.connection() as conn:
+            async with conn.cursor() as cur:
+                await self.run(cur, statement, params, many=True)
+                await conn.commit()
+        return ()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Cursor whose statements are committed together, or rolled back on error."""
+        async with self.connection() as conn:
+            await conn.begin()
+            try:
                 async with conn.cursor() as cur:
-                    await cur.executemany(statement, params)
-                    await conn.commit()
-            return ()
-        raise Exception("Could not connect to the local MariaDB instance!")
+                    yield TimedCursor(self, cur)
+            except BaseException:
+                await conn.rollback()
+                raise
+            await conn.commit()
@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+
+from loguru import logger
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+@dataclass
+class CacheEntry:
+    digest: str
+    size: int
+    expires: float
+
+
+def ttl_from_headers(headers) -> Optional[int]:
+    """Seconds the response may be cached for, or None if it must not be cached."""
+    cache_control = headers.get("Cache-Control", "")
+    if "no-store" in cache_control or "private" in cache_control:
+        return None
+
+    max_age = MAX_AGE_PATTERN.search(cache_control)
+    if max_age:
+        return int(max_age.group(1)) or None
+
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            ttl = int(parsedate_to_datetime(expires).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return DEFAULT_TTL
+        return ttl if ttl > 0 else None
+
+    return DEFAULT_TTL
+
+
+class MediaCache:
+    """
+    Media files stored on disk by the sha256 of their content, looked up by media url.
+    The least recently used urls are evicted once the unique files go over max_size bytes.
+    """
+
+    SAVE_DELAY = 30
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = Path(directory)
+        self.index_file = self.directory / "index.json"
+        self.max_size = max_size
+        self.entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.references: dict[str, int] = {}
+        self.total_size = 0
+        self.save_task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def blob_path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+
+    def load(self):
+        if not self.enabled:
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            index = json.loads(self.index_file.read_text())
+        except FileNotFoundError:
+            index = []
+        except ValueError as e:
+            logger.error(f"Media cache index is corrupted, starting empty: {e}")
+            index = []
+
+        now = time.time()
+        for url, entry in index:
+            entry = CacheEntry(**entry)
+            if entry.expires > now and self.blob_path(entry.digest).exists():
+                self._link(url, entry)
+
+        self._delete_blobs(self._evict())
+        self._remove_orphans()
+        logger.info(
+            f"Loaded media cache with {len(self.entries)} urls, "
+            f"{self.total_size / 1024**2:.2f}MB on disk"
+        )
+
+    def _remove_orphans(self):
+        # blobs written after the index was last saved are not referenced by anything
+        for path in self.directory.glob("*/*"):
+            if path.name not in self.references:
+                path.unlink(missing_ok=True)
+
+    async def get(self, url: str) -> Optional[bytes]:
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+
+        if entry.expires < time.time():
+            await self._delete_later(self._unlink(url))
+            return None
+
+        try:
+            data = await asyncio.to_thread(self.blob_path(entry.digest).read_bytes)
+        except FileNotFoundError:
+            if self.entries.get(url) is entry:
+                await self._delete_later(self._unlink(url))
+            return None
+
+        # a concurrent put may have evicted the url while the file was being read
+        if url in self.entries:
+            self.entries.move_to_end(url)
+        return data
+
+    async def put(self, url: str, data: bytes, headers):
+        if not self.enabled or len(data) > self.max_size:
+            return
+
+        ttl = ttl_from_headers(headers)
+        if ttl is None:
+            return
+
+        # hashing up to the upload limit would stall the event loop, so it is done in the thread
+        digest = await asyncio.to_thread(self._write_blob, data)
+
+        unused = []
+        if url in self.entries:
+            unused += self._unlink(url)
+        self._link(url, CacheEntry(digest, len(data), time.time() + ttl))
+        unused += self._evict()
+        self.schedule_save()
+        await self._delete_later(unused)
+
+    def _write_blob(self, data: bytes) -> str:
+        """Store the data under its digest unless it is already stored, and return the digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if digest in self.references and path.exists():
+            return digest
+
+        path.parent.mkdir(exist_ok=True)
+        # concurrent puts of the same content must not share a temporary file
+        temp_path = path.with_name(f"{digest}.{uuid.uuid4().hex}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        return digest
+
+    def _link(self, url: str, entry: CacheEntry):
+        self.entries[url] = entry
+        if entry.digest not in self.references:
+            self.references[entry.digest] = 0
+            self.total_size += entry.size
+        self.references[entry.digest] += 1
+
+    def _unlink(self, url: str) -> list[str]:
+        """Forget the url, and return the digest of its blob if nothing else uses it anymore."""
+        entry = self.entries.pop(url)
+        self.references[entry.digest] -= 1
+        if self.references[entry.digest] == 0:
+            del self.references[entry.digest]
+            self.total_size -= entry.size
+            return [entry.digest]
+        return []
+
+    def _evict(self) -> list[str]:
+        unused = []
+        while self.total_size > self.max_size and self.entries:
+            unused += self._unlink(next(iter(self.entries)))
+        return unused
+
+    async def _delete_later(self, digests: list[str]):
+        if digests:
+            await asyncio.to_thread(self._delete_blobs, digests)
+
+    def _delete_blobs(self, digests: list[str]):
+        for digest in digests:
+            # the same content may have been put again in the meantime
+            if digest not in self.references:
+                self.blob_path(digest).unlink(missing_ok=True)
+
+    def schedule_save(self):
+        if self.save_task is None or self.save_task.done():
+            self.save_task = asyncio.create_task(self._delayed_save())
+
+    async def _delayed_save(self):
+        await asyncio.sleep(self.SAVE_DELAY)
+        await self.save()
+
+    async def save(self):
+        if not self.enabled:
+            return
+
+        index = [(url, asdict(entry)) for url, entry in self.entries.items()]
+        await asyncio.to_thread(self._write_index, json.dumps(index))
+
+    def _write_index(self, content: str):
+        temp_path = self.index_file.with_suffix(".tmp")
+        temp_path.write_text(content)
+        os.replace(temp_path, self.index_file)
+
+    async def close(self):
+        if self.save_task is not None:
+            self.save_task.cancel()
+        await self.save()
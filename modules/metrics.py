@@ -0,0 +1,210 @@
+import bisect
+import math
+from typing import Callable, Iterator, Optional
+
+from aiohttp import web
+from loguru import logger
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+SIZE_BUCKETS = tuple(2**i * 1024 for i in range(4, 17, 2)) + (math.inf,)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    return "+Inf" if value == math.inf else repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children: dict[tuple[str, ...], "Metric"] = {}
+
+    def labels(self, *values: str) -> "Metric":
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.child()
+        return child
+
+    def child(self) -> "Metric":
+        return type(self)(self.name, self.documentation)
+
+    def samples(self, labels: dict[str, str]) -> Iterator[str]:
+        raise NotImplementedError
+
+    def collect(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        if self.labelnames:
+            for values, child in list(self.children.items()):
+                yield from child.samples(dict(zip(self.labelnames, values)))
+        else:
+            yield from self.samples({})
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, labels):
+        yield f"{self.name}{format_labels(labels)} {format_value(self.value)}"
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from a function when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def samples(self, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.warning(f"Could not read gauge {self.name}: {e}")
+                return
+        yield f"{self.name}{format_labels(labels)} {format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = TIME_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            bucket_labels = format_labels({**labels, "le": format_value(bound)})
+            yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+        yield f"{self.name}_sum{format_labels(labels)} {format_value(self.sum)}"
+        yield f"{self.name}_count{format_labels(labels)} {self.count}"
+
+
+TWEETS_RECEIVED = Counter("siniara_tweets_received_total", "Tweets received from the stream")
+TWEETS_DISPATCHED = Counter(
+    "siniara_tweets_dispatched_total", "Streamed tweets sent to at least one channel"
+)
+TWEETS_FILTERED = Counter(
+    "siniara_tweets_filtered_total", "Tweets not sent to a channel because it is media only"
+)
+SEND_FAILURES = Counter("siniara_send_failures_total", "Tweets that failed to send to a channel")
+STREAM_RECONNECTS = Counter("siniara_stream_reconnects_total", "Reconnects to the filtered stream")
+
+DB_QUERY_SECONDS = Histogram("siniara_db_query_seconds", "Database query time", ("query",))
+MEDIA_DOWNLOAD_BYTES = Histogram(
+    "siniara_media_download_bytes", "Size of downloaded media files", buckets=SIZE_BUCKETS
+)
+MEDIA_DOWNLOAD_SECONDS = Histogram("siniara_media_download_seconds", "Media download time")
+DISCORD_SEND_SECONDS = Histogram("siniara_discord_send_seconds", "Time to post a tweet message")
+SEND_WAIT_SECONDS = Histogram(
+    "siniara_send_wait_seconds", "Time messages waited for a send slot in the scheduler"
+)
+DISPATCH_WAIT_SECONDS = Histogram(
+    "siniara_dispatch_wait_seconds", "Time items waited in a dispatch queue", ("dispatcher",)
+)
+DISPATCH_HANDLE_SECONDS = Histogram(
+    "siniara_dispatch_handle_seconds", "Time to handle a dispatched item", ("dispatcher",)
+)
+
+DISPATCH_IN_FLIGHT = Gauge("siniara_dispatch_in_flight", "Tweets being sent right now")
+DISPATCH_QUEUED = Gauge("siniara_dispatch_queued", "Tweets waiting in the dispatch queue")
+DB_POOL_IN_USE = Gauge("siniara_db_pool_in_use", "Database connections in use")
+DB_POOL_SIZE = Gauge("siniara_db_pool_size", "Open database connections")
+PENDING_DELETIONS = Gauge("siniara_pending_deletions", "Follows waiting to be deleted")
+
+METRICS = [
+    TWEETS_RECEIVED,
+    TWEETS_DISPATCHED,
+    TWEETS_FILTERED,
+    SEND_FAILURES,
+    STREAM_RECONNECTS,
+    DB_QUERY_SECONDS,
+    MEDIA_DOWNLOAD_BYTES,
+    MEDIA_DOWNLOAD_SECONDS,
+    DISCORD_SEND_SECONDS,
+    SEND_WAIT_SECONDS,
+    DISPATCH_WAIT_SECONDS,
+    DISPATCH_HANDLE_SECONDS,
+    DISPATCH_IN_FLIGHT,
+    DISPATCH_QUEUED,
+    DB_POOL_IN_USE,
+    DB_POOL_SIZE,
+    PENDING_DELETIONS,
+]
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics in the prometheus text format at /metrics."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Serving metrics at http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
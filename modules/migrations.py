@@ -0,0 +1,62 @@
+import os
+import re
+
+import arrow
+from loguru import logger
+
+from modules.maria import Query
+
+MIGRATIONS_DIR = "sql/migrations"
+MIGRATION_FILENAME = re.compile(r"(\d+)_(\w+)\.sql")
+
+CREATE_SCHEMA_VERSION = Query(
+    "create_schema_version",
+    """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INT,
+        name VARCHAR(255),
+        applied_on DATETIME,
+        PRIMARY KEY (version)
+    )
+    """,
+)
+GET_SCHEMA_VERSION = Query(
+    "get_schema_version", "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+)
+SET_SCHEMA_VERSION = Query("set_schema_version", "INSERT INTO schema_version VALUES (%s, %s, %s)")
+
+
+def find_migrations(directory: str) -> list[tuple[int, str, str]]:
+    """Every migration in the directory as (version, name, path), oldest first."""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILENAME.fullmatch(filename)
+        if match:
+            migrations.append(
+                (int(match.group(1)), match.group(2), os.path.join(directory, filename))
+            )
+    return sorted(migrations)
+
+
+def split_statements(sql: str) -> list[str]:
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+async def migrate(db, directory: str = MIGRATIONS_DIR):
+    """
+    Apply every migration newer than the current schema version, in order.
+    MariaDB commits schema changes as it goes, so a migration that fails halfway is not rolled
+    back; write the statements so that they can be run again.
+    """
+    await db.execute(CREATE_SCHEMA_VERSION)
+    current = await db.execute(GET_SCHEMA_VERSION, one_value=True)
+    for version, name, path in find_migrations(directory):
+        if version <= current:
+            continue
+        with open(path) as f:
+            statements = split_statements(f.read())
+        for i, statement in enumerate(statements, start=1):
+            await db.execute(Query(f"migration {version}.{i}", statement))
+        await db.execute(SET_SCHEMA_VERSION, version, name, arrow.now().datetime)
+        logger.info(f"Applied database migration {version} {name}")
@@ -1,55 +1,133 @@
+import functools
+
 from loguru import logger
 
+from modules.maria import Query
+
+GET_FILTER = Query("get_filter", "SELECT DISTINCT twitter_user_id FROM follow")
+
 
 async def get_filter(db):
-    data = await db.execute("SELECT DISTINCT twitter_user_id FROM follow")
+    data = await db.execute(GET_FILTER)
     return [str(x[0]) for x in data]
 
 
-async def get_all_users(db) -> list[str]:
-    data = await db.execute(
-        """
-        SELECT DISTINCT username
-            FROM follow
-            JOIN twitter_user
-            ON twitter_user_id=user_id
+GET_FOLLOW_PAIRS = Query("get_follow_pairs", "SELECT channel_id, twitter_user_id FROM follow")
+
+
+async def get_follow_pairs(db) -> list[tuple[int, int]]:
+    data = await db.execute(GET_FOLLOW_PAIRS)
+    return [(x[0], x[1]) for x in data]
+
+
+GET_FOLLOW_CHECKSUM = Query(
+    "get_follow_checksum",
     """
-    )
-    return [x[0] for x in data]
+    SELECT COUNT(*), COALESCE(BIT_XOR(CRC32(CONCAT(channel_id, ':', twitter_user_id))), 0)
+        FROM follow
+    """,
+)
+
+
+async def get_follow_checksum(db) -> tuple[int, int]:
+    count, checksum = await db.execute(GET_FOLLOW_CHECKSUM, one_row=True)
+    return int(count), int(checksum)
+
+
+GET_CHANNELS = Query(
+    "get_channels", "SELECT DISTINCT channel_id FROM follow WHERE twitter_user_id = %s"
+)
 
 
 async def get_channels(db, twitter_user_id) -> list[int]:
-    data = await db.execute(
-        "SELECT DISTINCT channel_id FROM follow WHERE twitter_user_id = %s", twitter_user_id
-    )
+    data = await db.execute(GET_CHANNELS, twitter_user_id)
     return [x[0] for x in data]
 
 
+LIST_FOLLOWS = Query(
+    "list_follows",
+    """
+    SELECT twitter_user.username, channel_id, added_on
+    FROM follow LEFT JOIN twitter_user
+    ON twitter_user.user_id = follow.twitter_user_id WHERE follow.guild_id = %s
+    ORDER BY channel_id, added_on DESC
+    """,
+)
+LIST_CHANNEL_FOLLOWS = Query(
+    "list_channel_follows",
+    """
+    SELECT twitter_user.username, channel_id, added_on
+    FROM follow LEFT JOIN twitter_user
+    ON twitter_user.user_id = follow.twitter_user_id
+    WHERE follow.guild_id = %s AND channel_id = %s
+    ORDER BY added_on DESC
+    """,
+)
+
+
+async def list_follows(db, guild_id, channel_id=None):
+    if channel_id is None:
+        return await db.execute(LIST_FOLLOWS, guild_id)
+    return await db.execute(LIST_CHANNEL_FOLLOWS, guild_id, channel_id)
+
+
+IS_FOLLOWED_IN_GUILD = Query(
+    "is_followed_in_guild",
+    "SELECT 1 FROM follow WHERE twitter_user_id = %s AND guild_id = %s LIMIT 1",
+)
+
+
+async def is_followed_in_guild(db, twitter_user_id, guild_id) -> bool:
+    return bool(await db.execute(IS_FOLLOWED_IN_GUILD, twitter_user_id, guild_id, one_value=True))
+
+
+UNLOCK_GUILD = Query("unlock_guild", "UPDATE guild SET follow_limit = %s WHERE guild_id = %s")
+
+
 async def unlock_guild(db, guild_id):
     await db.execute(
-        "UPDATE guild SET follow_limit = %s WHERE guild_id = %s",
+        UNLOCK_GUILD,
         db.bot.config.guild_unlocked_follow_limit,
         guild_id,
     )
 
 
-async def get_follow_limit(db, guild_id) -> tuple[int, int]:
-    await db.execute(
-        "INSERT INTO guild VALUES (%s, %s) ON DUPLICATE KEY UPDATE guild_id = guild_id",
-        guild_id,
-        db.bot.config.guild_follow_limit,
-    )
-    limit = await db.execute(
-        "SELECT follow_limit FROM guild WHERE guild_id = %s", guild_id, one_row=True
+GET_FOLLOW_LIMIT = Query(
+    "get_follow_limit", "SELECT follow_count, follow_limit FROM guild WHERE guild_id = %s"
+)
+CREATE_GUILD = Query(
+    "create_guild",
+    """
+    INSERT INTO guild (guild_id, follow_limit, follow_count)
+        SELECT %s, %s, COUNT(DISTINCT twitter_user_id) FROM follow WHERE guild_id = %s
+    ON DUPLICATE KEY UPDATE follow_count = VALUES(follow_count)
+    """,
+)
+REFRESH_FOLLOW_COUNTS = Query(
+    "refresh_follow_counts",
+    """
+    UPDATE guild SET follow_count = (
+        SELECT COUNT(DISTINCT twitter_user_id) FROM follow WHERE follow.guild_id = guild.guild_id
     )
+    WHERE guild_id IN %s
+    """,
+)
 
-    current = await db.execute(
-        "SELECT COUNT(DISTINCT twitter_user_id) FROM follow WHERE guild_id = %s",
-        guild_id,
-        one_row=True,
-    )
-    current = current[0] if current else 0
-    return current, limit[0]
+
+async def get_follow_limit(db, guild_id) -> tuple[int, int]:
+    data = await db.execute(GET_FOLLOW_LIMIT, guild_id, one_row=True)
+    if not data:
+        await db.execute(CREATE_GUILD, guild_id, db.bot.config.guild_follow_limit, guild_id)
+        data = await db.execute(GET_FOLLOW_LIMIT, guild_id, one_row=True)
+
+    current, limit = data
+    return current, limit
+
+
+async def refresh_follow_counts(cur, guild_ids):
+    """Recount the followed users of the guilds, in the transaction that changed their follows."""
+    if guild_ids:
+        await cur.execute(REFRESH_FOLLOW_COUNTS, (list(guild_ids),))
 
 
 async def add_rule(db, guild_id, rule_type, constraint, value):
@@ -63,15 +141,19 @@ async def add_rule(db, guild_id, rule_type, constraint, value):
         raise ValueError
 
     await db.execute(
-        f"""INSERT INTO {table} (guild_id, {column}, media_only)
-            VALUES (%s, %s, %s)
-        ON DUPLICATE KEY UPDATE media_only = %s
-        """,
+        Query(
+            f"add_{table}",
+            f"""INSERT INTO {table} (guild_id, {column}, media_only)
+                VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE media_only = %s
+            """,
+        ),
         guild_id,
         constraint,
         value,
         value,
     )
+    db.bot.settings_cache.invalidate(guild_id)
 
 
 async def set_config_guild(db, guild_id, setting, value):
@@ -80,12 +162,16 @@ async def set_config_guild(db, guild_id, setting, value):
         logger.error(f"Ignored configtype {setting} from executing in the database!")
     else:
         await db.execute(
-            "INSERT INTO guild_settings(guild_id, " + setting + ") VALUES (%s, %s) "
-            "ON DUPLICATE KEY UPDATE " + setting + " = %s",
+            Query(
+                f"set_guild_{setting}",
+                "INSERT INTO guild_settings(guild_id, " + setting + ") VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE " + setting + " = %s",
+            ),
             guild_id,
             value,
             value,
         )
+        db.bot.settings_cache.invalidate(guild_id)
 
 
 async def set_config_channel(db, channel, setting, value):
@@ -94,10 +180,13 @@ async def set_config_channel(db, channel, setting, value):
         logger.error(f"Ignored configtype {setting} from executing in the database!")
     else:
         await db.execute(
-            "INSERT INTO channel_settings(channel_id, guild_id, "
-            + setting
-            + ") VALUES (%s, %s, %s) "
-            "ON DUPLICATE KEY UPDATE " + setting + " = %s",
+            Query(
+                f"set_channel_{setting}",
+                "INSERT INTO channel_settings(channel_id, guild_id, "
+                + setting
+                + ") VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE " + setting + " = %s",
+            ),
             channel.id,
             channel.guild.id,
             value,
@@ -111,10 +200,13 @@ async def set_config_user(db, guild_id, user_id, setting, value):
         logger.error(f"Ignored configtype {setting} from executing in the database!")
     else:
         await db.execute(
-            "INSERT INTO user_settings(guild_id, twitter_user_id, "
-            + setting
-            + ") VALUES (%s, %s, %s) "
-            "ON DUPLICATE KEY UPDATE " + setting + " = %s",
+            Query(
+                f"set_user_{setting}",
+                "INSERT INTO user_settings(guild_id, twitter_user_id, "
+                + setting
+                + ") VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE " + setting + " = %s",
+            ),
             guild_id,
             user_id,
             value,
@@ -122,23 +214,7 @@ async def set_config_user(db, guild_id, user_id, setting, value):
         )
 
 
-async def tweet_config(db, channel, user_id):
-    channel_setting = await db.execute(
-        "SELECT media_only FROM channel_rule WHERE channel_id = %s",
-        channel.id,
-        one_value=True,
-    )
-    guild_media_only, guild_show_captions = await db.execute(
-        "SELECT media_only, show_captions FROM guild_settings WHERE guild_id = %s",
-        channel.guild.id,
-        one_row=True,
-    ) or (None, None)
-    user_setting = await db.execute(
-        "SELECT media_only FROM user_rule WHERE twitter_user_id = %s AND guild_id = %s",
-        user_id,
-        channel.guild.id,
-        one_value=True,
-    )
+def resolve_config(channel_setting, guild_media_only, guild_show_captions, user_setting) -> dict:
     config = {}
 
     if user_setting in (True, False):
@@ -156,7 +232,71 @@ async def tweet_config(db, channel, user_id):
     return config
 
 
+@functools.lru_cache(maxsize=64)
+def tweet_configs_query(destinations: int) -> Query:
+    """Tweet config lookup for the given number of (channel_id, guild_id) destinations."""
+    rows = " UNION ALL ".join(["SELECT %s AS channel_id, %s AS guild_id"] * destinations)
+    return Query(
+        "tweet_configs",
+        f"""
+        SELECT destination.channel_id, destination.guild_id,
+            channel_rule.media_only, guild_settings.media_only,
+            guild_settings.show_captions, user_rule.media_only
+        FROM ({rows}) AS destination
+        LEFT JOIN channel_rule
+            ON channel_rule.channel_id = destination.channel_id
+        LEFT JOIN guild_settings
+            ON guild_settings.guild_id = destination.guild_id
+        LEFT JOIN user_rule
+            ON user_rule.guild_id = destination.guild_id AND user_rule.twitter_user_id = %s
+        """,
+    )
+
+
+async def tweet_configs(db, channels, user_id) -> dict[int, dict]:
+    """Resolve the tweet config of every channel, in one query for those not cached yet."""
+    cache = db.bot.settings_cache
+    configs = {}
+    missing = []
+    for channel in channels:
+        config = cache.get(channel.guild.id, channel.id, user_id)
+        if config is None:
+            missing.append(channel)
+        else:
+            configs[channel.id] = config
+
+    if not missing:
+        return configs
+
+    params = []
+    for channel in missing:
+        params += [channel.id, channel.guild.id]
+
+    data = await db.execute(tweet_configs_query(len(missing)), *params, user_id)
+    for channel_id, guild_id, *settings in data:
+        config = resolve_config(*settings)
+        cache.put(guild_id, channel_id, user_id, config)
+        configs[channel_id] = config
+
+    return configs
+
+
+async def tweet_config(db, channel, user_id):
+    configs = await tweet_configs(db, [channel], user_id)
+    return configs[channel.id]
+
+
+CLEAR_CHANNEL_SETTINGS = Query(
+    "clear_channel_settings", "DELETE FROM channel_settings WHERE guild_id = %s"
+)
+CLEAR_USER_SETTINGS = Query("clear_user_settings", "DELETE FROM user_settings WHERE guild_id = %s")
+CLEAR_GUILD_SETTINGS = Query(
+    "clear_guild_settings", "DELETE FROM guild_settings WHERE guild_id = %s"
+)
+
+
 async def clear_config(db, guild):
-    await db.execute("DELETE FROM channel_settings WHERE guild_id = %s", guild.id)
-    await db.execute("DELETE FROM user_settings WHERE guild_id = %s", guild.id)
-    await db.execute("DELETE FROM guild_settings WHERE guild_id = %s", guild.id)
+    await db.execute(CLEAR_CHANNEL_SETTINGS, guild.id)
+    await db.execute(CLEAR_USER_SETTINGS, guild.id)
+    await db.execute(CLEAR_GUILD_SETTINGS, guild.id)
+    db.bot.settings_cache.invalidate(guild.id)
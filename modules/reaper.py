@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+from datetime import datetime, timedelta
+from typing import Optional
+
+import arrow
+from loguru import logger
+
+from modules import metrics, queries
+
+
+class FollowReaper:
+    """
+    Deletes the follows of channels that no longer exist. A follow is only deleted once it has
+    been queued for GRACE_PERIOD seconds and its guild is available, so guilds that are slow to
+    load or in an outage don't lose their follows. Due deletions are handled as soon as
+    THRESHOLD of them are waiting, and every INTERVAL seconds otherwise.
+    Queued follows are written to the pending_deletion table in the background,
+    so that they survive restarts without the tweet delivery path waiting on the database.
+    """
+
+    THRESHOLD = 100
+    BATCH_SIZE = 1000
+    INTERVAL = 60 * 60
+    GRACE_PERIOD = 24 * 60 * 60
+    SAVE_DELAY = 5
+    RETRY_DELAY = 60
+
+    def __init__(self, bot):
+        self.bot = bot
+        # (channel_id, twitter_user_id) -> queued_on
+        self.pending: dict[tuple[int, int], datetime] = {}
+        # queued but not written to the database yet
+        self.unsaved: set[tuple[int, int]] = set()
+        # due, but waiting for their guild to become available
+        self.parked: set[tuple[int, int]] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.save_task: Optional[asyncio.Task] = None
+        metrics.PENDING_DELETIONS.set_function(lambda: len(self))
+
+    def __len__(self):
+        return len(self.pending)
+
+    async def load(self):
+        data = await self.bot.db.execute(
+            "SELECT channel_id, twitter_user_id, queued_on FROM pending_deletion"
+        )
+        self.pending = {(channel_id, user_id): queued_on for channel_id, user_id, queued_on in data}
+        if self.pending:
+            logger.info(f"{len(self.pending)} follows are waiting for deletion")
+
+    def queue(self, channel_id: int, twitter_user_id: int):
+        pair = (channel_id, twitter_user_id)
+        if pair in self.pending:
+            return
+
+        self.pending[pair] = arrow.now().naive
+        self.unsaved.add(pair)
+        if self.save_task is None or self.save_task.done():
+            self.save_task = asyncio.create_task(self.save_later())
+
+    async def save_later(self):
+        await asyncio.sleep(self.SAVE_DELAY)
+        pairs, self.unsaved = self.unsaved, set()
+        rows = [(*pair, self.pending[pair]) for pair in pairs if pair in self.pending]
+        try:
+            if rows:
+                await self.bot.db.executemany(
+                    "INSERT IGNORE INTO pending_deletion VALUES (%s, %s, %s)", rows
+                )
+        except Exception as e:
+            logger.error("Unhandled exception in saving pending deletions")
+            logger.error(e)
+            # try again with the next queued follow, they are still pending in memory
+            self.unsaved.update(pairs)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def next_run(self) -> float:
+        """Seconds until THRESHOLD deletions are due, or INTERVAL if that is sooner."""
+        candidates = (
+            queued_on for pair, queued_on in self.pending.items() if pair not in self.parked
+        )
+        oldest = heapq.nsmallest(self.THRESHOLD, candidates)
+        if len(oldest) < self.THRESHOLD:
+            return self.INTERVAL
+        due_at = oldest[-1] + timedelta(seconds=self.GRACE_PERIOD)
+        return max(0.0, min(self.INTERVAL, (due_at - arrow.now().naive).total_seconds()))
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(self.next_run())
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error("Unhandled exception in follow reaper")
+                logger.error(e)
+                await asyncio.sleep(self.RETRY_DELAY)
+
+    async def reap(self):
+        """Delete the follows that have been queued for longer than the grace period."""
+        cutoff = arrow.now().shift(seconds=-self.GRACE_PERIOD).naive
+        due = [pair for pair, queued_on in self.pending.items() if queued_on <= cutoff]
+        for i in range(0, len(due), self.BATCH_SIZE):
+            await self.reap_batch(due[i : i + self.BATCH_SIZE])
+
+    async def reap_batch(self, batch: list[tuple[int, int]]):
+        # the channel might just have been unavailable for a moment
+        restored = [pair for pair in batch if self.bot.get_channel(pair[0]) is not None]
+        missing = [pair for pair in batch if self.bot.get_channel(pair[0]) is None]
+        gone = []
+        waiting = set()
+
+        async with self.bot.db.transaction() as cur:
+            if missing:
+                await cur.execute(
+                    "SELECT channel_id, twitter_user_id, guild_id FROM follow "
+                    "WHERE (channel_id, twitter_user_id) IN %s",
+                    (missing,),
+                )
+                changed_guilds = set()
+                for channel_id, twitter_user_id, guild_id in await cur.fetchall():
+                    guild = self.bot.get_guild(guild_id)
+                    if guild is None or guild.unavailable:
+                        # can't tell if the channel is gone until the guild is back
+                        waiting.add((channel_id, twitter_user_id))
+                    else:
+                        gone.append((channel_id, twitter_user_id))
+                        changed_guilds.add(guild_id)
+
+                if gone:
+                    await cur.execute(
+                        "DELETE FROM follow WHERE (channel_id, twitter_user_id) IN %s", (gone,)
+                    )
+                    await queries.refresh_follow_counts(cur, list(changed_guilds))
+
+            # follows that were already removed some other way are done with too
+            done = [pair for pair in batch if pair not in waiting]
+            if done:
+                await cur.execute(
+                    "DELETE FROM pending_deletion WHERE (channel_id, twitter_user_id) IN %s",
+                    (done,),
+                )
+
+        for pair in done:
+            self.pending.pop(pair, None)
+            self.parked.discard(pair)
+            self.unsaved.discard(pair)
+        self.parked.update(waiting)
+        for channel_id, twitter_user_id in gone:
+            self.bot.routing.remove(channel_id, twitter_user_id)
+        if gone:
+            self.bot.dispatch("follows_changed")
+        logger.info(
+            f"Deleted {len(gone)} follows of missing channels, {len(restored)} came back, "
+            f"{len(waiting)} are waiting for their guild"
+        )
@@ -0,0 +1,98 @@
+import asyncio
+import zlib
+from collections import defaultdict
+from typing import Callable, Optional
+
+from loguru import logger
+
+from modules import queries
+
+
+def pair_checksum(channel_id: int, twitter_user_id: int) -> int:
+    # must match CRC32(CONCAT(channel_id, ':', twitter_user_id)) on the database side
+    return zlib.crc32(f"{channel_id}:{twitter_user_id}".encode())
+
+
+class RoutingIndex:
+    """In-memory copy of the follow table, mapping twitter user ids to discord channel ids."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.channels: dict[int, set[int]] = {}
+        self.pair_count = 0
+        self.checksum = 0
+        # changes made while a load is reading the database, replayed once it is done
+        self.pending_changes: Optional[list[tuple[Callable, int, int]]] = None
+        self.load_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.channels)
+
+    def get_channels(self, twitter_user_id: int) -> list[int]:
+        return list(self.channels.get(twitter_user_id, ()))
+
+    def user_ids(self) -> list[int]:
+        return list(self.channels.keys())
+
+    def add(self, channel_id: int, twitter_user_id: int):
+        if self.pending_changes is not None:
+            self.pending_changes.append((self.add, channel_id, twitter_user_id))
+        channels = self.channels.setdefault(twitter_user_id, set())
+        if channel_id not in channels:
+            channels.add(channel_id)
+            self.pair_count += 1
+            self.checksum ^= pair_checksum(channel_id, twitter_user_id)
+
+    def remove(self, channel_id: int, twitter_user_id: int):
+        if self.pending_changes is not None:
+            self.pending_changes.append((self.remove, channel_id, twitter_user_id))
+        channels = self.channels.get(twitter_user_id)
+        if channels is None or channel_id not in channels:
+            return
+
+        channels.remove(channel_id)
+        self.pair_count -= 1
+        self.checksum ^= pair_checksum(channel_id, twitter_user_id)
+        if not channels:
+            del self.channels[twitter_user_id]
+
+    def remove_user(self, twitter_user_id: int):
+        for channel_id in self.get_channels(twitter_user_id):
+            self.remove(channel_id, twitter_user_id)
+
+    async def load(self):
+        async with self.load_lock:
+            self.pending_changes = []
+            try:
+                pairs = await queries.get_follow_pairs(self.bot.db)
+            finally:
+                changes, self.pending_changes = self.pending_changes, None
+            self.replace(pairs)
+            # add and remove are idempotent, so changes already in the result are harmless
+            for change, channel_id, twitter_user_id in changes:
+                change(channel_id, twitter_user_id)
+
+        logger.info(f"Loaded routing index with {self.pair_count} follows of {len(self)} users")
+
+    def replace(self, pairs: list[tuple[int, int]]):
+        channels = defaultdict(set)
+        checksum = 0
+        pair_count = 0
+        for channel_id, twitter_user_id in pairs:
+            channels[twitter_user_id].add(channel_id)
+            checksum ^= pair_checksum(channel_id, twitter_user_id)
+            pair_count += 1
+
+        self.channels = dict(channels)
+        self.checksum = checksum
+        self.pair_count = pair_count
+
+    async def reconcile(self):
+        """Compare against the database and rebuild the index if they have drifted apart."""
+        pair_count, checksum = await queries.get_follow_checksum(self.bot.db)
+        if pair_count != self.pair_count or checksum != self.checksum:
+            logger.warning(
+                f"Routing index out of sync ({self.pair_count} follows locally, "
+                f"{pair_count} in database), rebuilding"
+            )
+            await self.load()
@@ -0,0 +1,188 @@
+from loguru import logger
+from tweepy import StreamRule
+
+NO_RETWEETS = " -is:retweet"
+MAX_RULE_LENGTH = 512
+# "(" + ")" + NO_RETWEETS around the clauses, minus the " OR " the first clause doesn't have
+RULE_OVERHEAD = 2 + len(NO_RETWEETS) - 4
+
+
+def clause_length(username: str) -> int:
+    """Length a username adds to a rule, " OR from:username"."""
+    return len(username) + 9
+
+
+def rule_length(usernames: list[str]) -> int:
+    return RULE_OVERHEAD + sum(clause_length(u) for u in usernames)
+
+
+def rule_value(usernames: list[str]) -> str:
+    return "(" + " OR ".join("from:" + u for u in usernames) + ")" + NO_RETWEETS
+
+
+def rule_usernames(value: str) -> list[str]:
+    value = value.removesuffix(NO_RETWEETS).strip("()")
+    return [x.split(":")[1] for x in value.split(" OR ")]
+
+
+def pack_greedy(usernames: list[str]) -> list[list[str]]:
+    """Fill rules with usernames in the given order, starting a new rule when one is full."""
+    groups = []
+    group = []
+    length = RULE_OVERHEAD
+    for username in usernames:
+        if group and length + clause_length(username) > MAX_RULE_LENGTH:
+            groups.append(group)
+            group = []
+            length = RULE_OVERHEAD
+        group.append(username)
+        length += clause_length(username)
+    if group:
+        groups.append(group)
+    return groups
+
+
+class FreeSpaceTree:
+    """Max segment tree over the free space left in each rule, for O(log n) first-fit lookups."""
+
+    def __init__(self, rule_count: int, capacity: int):
+        self.size = 1
+        while self.size < rule_count:
+            self.size *= 2
+        self.tree = [capacity] * (2 * self.size)
+
+    def first_fit(self, length: int) -> int:
+        """Take `length` from the first rule it fits in and return that rule's index."""
+        tree = self.tree
+        node = 1
+        while node < self.size:
+            node *= 2
+            if tree[node] < length:
+                node += 1
+
+        index = node - self.size
+        tree[node] -= length
+        while node > 1:
+            node //= 2
+            best = max(tree[2 * node], tree[2 * node + 1])
+            if tree[node] == best:
+                # the parents above are unaffected as well
+                break
+            tree[node] = best
+        return index
+
+
+def pack_first_fit_decreasing(usernames: list[str]) -> list[list[str]]:
+    """Pack the longest usernames first, each into the first rule that still has room for it."""
+    if not usernames:
+        return []
+
+    # sorting by name too keeps the packing the same regardless of database order
+    ordered = sorted(usernames, key=lambda u: (-len(u), u.lower()))
+    free_space = FreeSpaceTree(len(ordered), MAX_RULE_LENGTH - RULE_OVERHEAD)
+    groups: list[list[str]] = []
+    for username in ordered:
+        index = free_space.first_fit(clause_length(username))
+        if index == len(groups):
+            groups.append([])
+        groups[index].append(username)
+    return groups
+
+
+PACKERS = {
+    "greedy": pack_greedy,
+    "ffd": pack_first_fit_decreasing,
+}
+
+
+class RuleManager:
+    """
+    Local model of which usernames live in which stream rule.
+    Changes in the followed users are applied by rewriting only the rules they touch,
+    adding the new rules before deleting the old ones so there is no gap in delivery.
+    Users that don't fit in any existing rule are packed into new ones with `packing`,
+    so a membership change never reshuffles the rules that weren't touched.
+    """
+
+    def __init__(self, stream, packing: str = "ffd"):
+        self.stream = stream
+        self.pack = PACKERS[packing]
+        self.rules: dict[str, list[str]] = {}
+        self.loaded = False
+
+    async def load(self):
+        response = await self.stream.get_rules()
+        self.rules = {rule.id: rule_usernames(rule.value) for rule in response.data or []}
+        self.loaded = True
+
+    def usernames(self) -> list[str]:
+        return [u for users in self.rules.values() for u in users]
+
+    def plan(self, followed_users: list[str]) -> tuple[list[list[str]], list[str]]:
+        """Work out the rules to add and the rule ids to delete to match followed_users."""
+        followed = {u.lower(): u for u in followed_users}
+        seen = set()
+        rewrites: dict[str, list[str]] = {}
+        for rule_id, users in self.rules.items():
+            keep = []
+            for username in users:
+                if username.lower() in followed and username.lower() not in seen:
+                    keep.append(username)
+                    seen.add(username.lower())
+            if len(keep) != len(users):
+                rewrites[rule_id] = keep
+
+        new_users = [username for key, username in followed.items() if key not in seen]
+        if new_users:
+            # longest first, like the packer, so the short names fill the gaps that are left
+            new_users.sort(key=lambda u: (-len(u), u.lower()))
+            # fill the rules we are rewriting anyway first, then the ones with the most room
+            candidates = list(rewrites) + sorted(
+                (rule_id for rule_id in self.rules if rule_id not in rewrites),
+                key=lambda rule_id: rule_length(self.rules[rule_id]),
+            )
+            remaining = []
+            for username in new_users:
+                for rule_id in candidates:
+                    users = rewrites.get(rule_id, self.rules[rule_id])
+                    if rule_length(users) + clause_length(username) <= MAX_RULE_LENGTH:
+                        rewrites[rule_id] = users + [username]
+                        break
+                else:
+                    remaining.append(username)
+            new_users = remaining
+
+        to_add = [users for users in rewrites.values() if users] + self.pack(new_users)
+        to_delete = list(rewrites)
+        return to_add, to_delete
+
+    async def sync(self, followed_users: list[str]) -> bool:
+        """Apply the changes needed to stream `followed_users`. Returns whether anything changed."""
+        if not self.loaded:
+            await self.load()
+
+        to_add, to_delete = self.plan(followed_users)
+        if not to_add and not to_delete:
+            return False
+
+        if to_add:
+            response = await self.stream.add_rules([StreamRule(rule_value(u)) for u in to_add])
+            if response.errors:  # type: ignore
+                logger.error(response.errors)  # type: ignore
+                # keep the old rules around and start from what twitter has next time
+                self.loaded = False
+                return True
+            for rule in response.data or []:  # type: ignore
+                self.rules[rule.id] = rule_usernames(rule.value)
+            logger.info(f"Added {len(to_add)} stream rules")
+
+        if to_delete:
+            response = await self.stream.delete_rules(to_delete)
+            if response.errors:  # type: ignore
+                logger.error(response.errors)  # type: ignore
+                self.loaded = False
+            for rule_id in to_delete:
+                self.rules.pop(rule_id, None)
+            logger.info(f"Deleted {len(to_delete)} stream rules")
+
+        return True
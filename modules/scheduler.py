@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, TypeVar
+
+from loguru import logger
+
+from modules import metrics
+
+T = TypeVar("T")
+
+
+class PrioritySemaphore:
+    """Semaphore that hands free slots to the waiter with the lowest priority value first."""
+
+    def __init__(self, value: int):
+        self.value = value
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+
+    @property
+    def busy(self) -> bool:
+        return self.value <= 0 or bool(self.waiters)
+
+    async def acquire(self, priority: int = 0):
+        if not self.busy:
+            self.value -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed to us right as we got cancelled, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.value += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class RateLimiter:
+    """Allows at most `limit` calls in any `period` seconds, making callers wait for room."""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self.calls: deque[float] = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.calls and self.calls[0] <= now - self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.limit:
+                    break
+                await asyncio.sleep(self.calls[0] + self.period - now)
+            self.calls.append(now)
+
+
+class SendScheduler:
+    """
+    Runs message sends concurrently, with at most PER_CHANNEL sends in flight per channel,
+    PER_GUILD per guild and `total` overall, which keeps us inside discord's per-channel
+    rate limit buckets instead of piling requests up behind them.
+    Free slots go to the lowest priority value first.
+    """
+
+    PER_CHANNEL = 1
+    PER_GUILD = 3
+    SLOW_WAIT = 5
+
+    def __init__(self, total: int):
+        self.total = PrioritySemaphore(total)
+        self.guilds: dict[int, PrioritySemaphore] = {}
+        self.channels: dict[int, PrioritySemaphore] = {}
+
+    @asynccontextmanager
+    async def _keyed_slot(self, registry: dict, key: int, limit: int, priority: int):
+        semaphore = registry.get(key)
+        if semaphore is None:
+            semaphore = registry[key] = PrioritySemaphore(limit)
+        try:
+            async with semaphore.slot(priority):
+                yield
+        finally:
+            # forget idle semaphores so that every channel ever sent to doesn't stay in memory
+            idle = semaphore.value == limit and not semaphore.waiters
+            if idle and registry.get(key) is semaphore:
+                del registry[key]
+
+    async def run(
+        self,
+        channel_id: int,
+        guild_id: int,
+        send: Callable[[], Awaitable[T]],
+        priority: int = 0,
+    ) -> T:
+        queued_at = time.monotonic()
+        # acquired from the narrowest to the widest,
+        # so that a busy channel never holds on to a guild or global slot while waiting
+        async with self._keyed_slot(self.channels, channel_id, self.PER_CHANNEL, priority):
+            async with self._keyed_slot(self.guilds, guild_id, self.PER_GUILD, priority):
+                async with self.total.slot(priority):
+                    waited = time.monotonic() - queued_at
+                    metrics.SEND_WAIT_SECONDS.observe(waited)
+                    if waited > self.SLOW_WAIT:
+                        logger.warning(
+                            f"Message to channel {channel_id} waited {waited:.2f}s to send"
+                        )
+                    return await send()
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from loguru import logger
+
+from modules.maria import Query
+
+
+class SettingsCache:
+    """
+    Resolved tweet configs, grouped by guild so that any settings change
+    in a guild can drop everything cached for it at once.
+    """
+
+    def __init__(self, max_guilds: int = 1000):
+        self.max_guilds = max_guilds
+        self.guilds: OrderedDict[int, dict[tuple[int, int], dict]] = OrderedDict()
+
+    def get(self, guild_id: int, channel_id: int, user_id: int) -> Optional[dict]:
+        configs = self.guilds.get(guild_id)
+        if configs is None:
+            return None
+        self.guilds.move_to_end(guild_id)
+        return configs.get((channel_id, user_id))
+
+    def put(self, guild_id: int, channel_id: int, user_id: int, config: dict):
+        configs = self.guilds.setdefault(guild_id, {})
+        configs[(channel_id, user_id)] = config
+        self.guilds.move_to_end(guild_id)
+        while len(self.guilds) > self.max_guilds:
+            self.guilds.popitem(last=False)
+
+    def invalidate(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+
+
+LOAD_GUILD_SETTINGS = Query(
+    "load_guild_settings",
+    """
+    SELECT 'guild', NULL, media_only, show_captions FROM guild_settings WHERE guild_id = %s
+    UNION ALL
+    SELECT 'channel', rule_id, channel_id, media_only FROM channel_rule WHERE guild_id = %s
+    UNION ALL
+    SELECT 'user', rule_id, twitter_user_id, media_only FROM user_rule WHERE guild_id = %s
+    """,
+)
+SAVE_GUILD_SETTINGS = Query(
+    "save_guild_settings",
+    """
+    INSERT INTO guild_settings (guild_id, media_only, show_captions) VALUES (%s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        media_only = VALUES(media_only), show_captions = VALUES(show_captions)
+    """,
+)
+
+
+class GuildSettingsSnapshot:
+    """
+    Everything the settings menu shows for one guild, loaded in a single query when the menu
+    opens. Changes are applied to the snapshot right away and written to the database
+    together, once there have been none for WRITE_DELAY seconds.
+    """
+
+    WRITE_DELAY = 3
+
+    def __init__(self, bot, guild_id: int):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.media_only: Optional[int] = None
+        self.show_captions: Optional[int] = None
+        # rule_id -> (channel or twitter user id, media_only)
+        self.rules: dict[str, dict[int, tuple[int, int]]] = {"channel": {}, "user": {}}
+        self.settings_changed = False
+        self.removed_rules: dict[str, set[int]] = {"channel": set(), "user": set()}
+        self.changed_at = 0.0
+        self.write_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def load(cls, bot, guild_id: int) -> "GuildSettingsSnapshot":
+        snapshot = cls(bot, guild_id)
+        data = await bot.db.execute(LOAD_GUILD_SETTINGS, guild_id, guild_id, guild_id)
+        for kind, rule_id, first, second in data:
+            if kind == "guild":
+                snapshot.media_only, snapshot.show_captions = first, second
+            else:
+                snapshot.rules[kind][rule_id] = (first, second)
+        return snapshot
+
+    def set(self, setting: str, value: int):
+        if setting not in ["media_only", "show_captions"]:
+            raise ValueError(setting)
+        setattr(self, setting, value)
+        self.settings_changed = True
+        self.schedule_write()
+
+    def remove_rule(self, kind: str, rule_id: int):
+        if self.rules[kind].pop(rule_id, None) is not None:
+            self.removed_rules[kind].add(rule_id)
+            self.schedule_write()
+
+    def schedule_write(self):
+        self.changed_at = time.monotonic()
+        if self.write_task is None or self.write_task.done():
+            self.write_task = asyncio.create_task(self.write_later())
+
+    async def write_later(self):
+        while (delay := self.changed_at + self.WRITE_DELAY - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        try:
+            await self.write()
+        except Exception as e:
+            logger.error("Unhandled exception in settings write")
+            logger.error(e)
+
+    async def write(self):
+        """Write every pending change to the database in one transaction."""
+        settings_changed = self.settings_changed
+        removed_rules = {kind: list(rule_ids) for kind, rule_ids in self.removed_rules.items()}
+        if not settings_changed and not any(removed_rules.values()):
+            return
+
+        self.settings_changed = False
+        for rule_ids in self.removed_rules.values():
+            rule_ids.clear()
+
+        try:
+            async with self.bot.db.transaction() as cur:
+                if settings_changed:
+                    await cur.execute(
+                        SAVE_GUILD_SETTINGS, (self.guild_id, self.media_only, self.show_captions)
+                    )
+                for kind, rule_ids in removed_rules.items():
+                    if rule_ids:
+                        await cur.execute(
+                            Query(
+                                f"remove_{kind}_rules",
+                                f"DELETE FROM {kind}_rule WHERE guild_id = %s AND rule_id IN %s",
+                            ),
+                            (self.guild_id, rule_ids),
+                        )
+        except Exception:
+            # keep the changes around for the next write
+            self.settings_changed |= settings_changed
+            for kind, rule_ids in removed_rules.items():
+                self.removed_rules[kind].update(rule_ids)
+            raise
+        self.bot.settings_cache.invalidate(self.guild_id)
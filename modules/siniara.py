@@ -9,7 +9,16 @@ from discord.ext import commands
 from loguru import logger
 from tweepy.asynchronous import AsyncClient
 
-from modules import maria
+from modules import maria, migrations
+from modules.identity import TwitterUserCache
+from modules.mediacache import MediaCache
+from modules.metrics import MetricsServer
+from modules.reaper import FollowReaper
+from modules.routing import RoutingIndex
+from modules.scheduler import SendScheduler
+from modules.settings import SettingsCache
+from modules.tracing import Tracer
+from modules.twitter import TweetLoader
 from modules.config import Config
 
 
@@ -44,6 +53,15 @@ class Siniara(commands.AutoShardedBot):
         self.start_time = time()
         self.twitter_blue = int("1da1f2", 16)
         self.db = maria.MariaDB(self)
+        self.routing = RoutingIndex(self)
+        self.twitter_users = TwitterUserCache(self)
+        self.reaper = FollowReaper(self)
+        self.settings_cache = SettingsCache()
+        self.tweet_loader = TweetLoader(self)
+        self.send_scheduler = SendScheduler(self.config.send_concurrency)
+        self.tracer = Tracer()
+        self.metrics_server = MetricsServer(self.config.metrics_host, self.config.metrics_port)
+        self.media_cache = MediaCache(self.config.media_cache_dir, self.config.media_cache_size)
         self.cogs_to_load = [
             "cogs.commands",
             "cogs.errorhandler",
@@ -53,24 +71,33 @@ class Siniara(commands.AutoShardedBot):
         ]
         # the user will never be none so don't ruin my type checking please
         self.user: discord.ClientUser
-        self.deletion_list = set()
 
     async def close(self):
+        # unloading the cogs drains any tweets still being dispatched,
+        # so the session and database have to stay open until that is done
+        await super().close()
         await self.session.close()
+        await self.metrics_server.stop()
+        await self.media_cache.close()
         await self.db.cleanup()
-        await super().close()
 
     async def on_ready(self):
         logger.info(f"Logged in as {self.user}")
 
     async def setup_hook(self):
         self.session = aiohttp.ClientSession()
+        if self.config.metrics_port:
+            await self.metrics_server.start()
         self.tweepy = AsyncClient(
             bearer_token=self.config.twitter_bearer_token,
             wait_on_rate_limit=True,
         )
         self.before_invoke(self.before_any_command)
+        self.media_cache.load()
         await self.db.initialize_pool()
+        await migrations.migrate(self.db)
+        await self.twitter_users.load()
+        await self.reaper.load()
         for extension in self.cogs_to_load:
             try:
                 await self.load_extension(extension)
@@ -0,0 +1,94 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+
+from loguru import logger
+
+current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Stage timings of one streamed tweet, from the moment it was received to its last post."""
+
+    def __init__(self, tweet_id: int, created_at: Optional[datetime] = None):
+        self.tweet_id = tweet_id
+        self.created_at = created_at
+        self.received_at = time.perf_counter()
+        self.spans: list[tuple[str, float]] = []
+
+    def add(self, stage: str, seconds: float):
+        self.spans.append((stage, seconds))
+
+
+@contextmanager
+def span(stage: str):
+    """Time the block as a stage of the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - started)
+
+
+def delivered():
+    """Record how long it took from the tweet being posted to it arriving in a channel."""
+    trace = current_trace.get()
+    if trace is not None and trace.created_at is not None:
+        trace.add("since_created", (datetime.now(timezone.utc) - trace.created_at).total_seconds())
+
+
+class Tracer:
+    """Rolling window of the stage timings of the latest traces."""
+
+    WINDOW = 1000
+    SLOW_THRESHOLD = 30
+    STAGES = [
+        "queued",
+        "route",
+        "hydrate",
+        "config",
+        "download",
+        "upload",
+        "fan_out",
+        "total",
+        "since_created",
+    ]
+
+    def __init__(self):
+        self.samples: dict[str, deque[float]] = {
+            stage: deque(maxlen=self.WINDOW) for stage in self.STAGES
+        }
+
+    @contextmanager
+    def activate(self, trace: Trace):
+        """Make the trace current for the block, and record it once the block is done."""
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            current_trace.reset(token)
+            self.finish(trace)
+
+    def finish(self, trace: Trace):
+        total = time.perf_counter() - trace.received_at
+        trace.add("total", total)
+        for stage, seconds in trace.spans:
+            self.samples.setdefault(stage, deque(maxlen=self.WINDOW)).append(seconds)
+
+        if total > self.SLOW_THRESHOLD:
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in trace.spans)
+            logger.warning(f"Tweet {trace.tweet_id} took {total:.2f}s to send ({stages})")
+
+    def percentiles(self, stage: str, points=(50, 90, 99)) -> list[float]:
+        samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return [0.0 for _ in points]
+        return [samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in points]
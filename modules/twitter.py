@@ -1,7 +1,11 @@
 import asyncio
+import functools
 import io
+import tempfile
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Union
+from typing import TYPE_CHECKING, Optional, Union
 
 import arrow
 import discord
@@ -9,10 +13,16 @@ import tweepy
 from discord.app_commands import AppCommandError
 from loguru import logger
 
-from modules import queries
-from modules.siniara import Siniara
+from modules import metrics, queries, tracing
 from modules.ui import LinkButton
 
+if TYPE_CHECKING:
+    from modules.siniara import Siniara
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 1024 * 1024
+
 SendableChannel = Union[
     discord.VoiceChannel,
     discord.TextChannel,
@@ -25,6 +35,10 @@ class NoMedia(AppCommandError, Exception):
     pass
 
 
+class TweetNotFound(AppCommandError, Exception):
+    pass
+
+
 @dataclass
 class TweetData:
     id: int
@@ -37,32 +51,177 @@ class TweetData:
     reply_to: Optional[str] = None
 
 
+@dataclass(frozen=True)
+class MediaFile:
+    """Media downloaded once per tweet and shared between all destination channels."""
+
+    filename: str
+    url: str
+    data: Optional[bytes] = None
+    error: Optional[str] = None
+
+    @property
+    def link(self) -> str:
+        return self.error or self.url
+
+    def fits(self, max_filesize: int) -> bool:
+        return self.data is not None and len(self.data) < max_filesize
+
+    def to_file(self) -> discord.File:
+        # BytesIO shares the memory of a bytes object until it is written to
+        return discord.File(fp=io.BytesIO(self.data), filename=self.filename)  # type: ignore
+
+
+CachedTweet = Union[TweetData, TweetNotFound]
+
+
+class TweetLoader:
+    """
+    Looks up tweets in batches. Lookups made within BATCH_WINDOW seconds of each other
+    are coalesced into a single get_tweets call, concurrent lookups of the same tweet
+    share one request, and parsed tweets are kept around for `ttl` seconds.
+    Tweets that could not be found are remembered for NOT_FOUND_TTL seconds.
+    """
+
+    BATCH_WINDOW = 0.05
+    BATCH_SIZE = 100
+    NOT_FOUND_TTL = 60
+
+    def __init__(self, bot, ttl: float = 300, max_size: int = 1000):
+        self.bot: "Siniara" = bot
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache: OrderedDict[int, tuple[float, CachedTweet]] = OrderedDict()
+        self.in_flight: dict[int, asyncio.Future] = {}
+        self.queue: list[int] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # referenced so that running fetches are not garbage collected
+        self.fetches: set[asyncio.Task] = set()
+
+    async def get(self, tweet_id: int) -> TweetData:
+        cached = self.cache.get(tweet_id)
+        if cached is not None:
+            expires, tweet = cached
+            if expires > time.monotonic():
+                self.cache.move_to_end(tweet_id)
+                if isinstance(tweet, TweetNotFound):
+                    raise TweetNotFound(*tweet.args)
+                return tweet
+            del self.cache[tweet_id]
+
+        future = self.in_flight.get(tweet_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.in_flight[tweet_id] = future
+            self.queue.append(tweet_id)
+            if len(self.queue) >= self.BATCH_SIZE:
+                self.flush()
+            elif self.flush_handle is None:
+                self.flush_handle = asyncio.get_running_loop().call_later(
+                    self.BATCH_WINDOW, self.flush
+                )
+
+        # shielded so that a cancelled caller does not fail the lookup for everyone else
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        while self.queue:
+            batch, self.queue = self.queue[: self.BATCH_SIZE], self.queue[self.BATCH_SIZE :]
+            task = asyncio.create_task(self.fetch(batch))
+            self.fetches.add(task)
+            task.add_done_callback(self.fetches.discard)
+
+    async def fetch(self, tweet_ids: list[int]):
+        errors = {}
+        try:
+            response = await self.bot.tweepy.get_tweets(
+                tweet_ids,
+                tweet_fields=["attachments", "created_at", "conversation_id", "entities"],
+                expansions=["attachments.media_keys", "author_id"],
+                media_fields=["variants", "url", "alt_text"],
+                user_fields=["profile_image_url"],
+            )
+            includes = response.includes  # type: ignore
+            users = {user.id: user for user in includes.get("users", [])}
+            media = {m.media_key: m for m in includes.get("media", [])}
+            for tweet in response.data or []:  # type: ignore
+                user = users.get(tweet.author_id)
+                if user is None:
+                    continue
+                tweet_media = [
+                    media[key]
+                    for key in (tweet.attachments or {}).get("media_keys", [])
+                    if key in media
+                ]
+                try:
+                    tweet_data = TwitterRenderer.parse_tweet(tweet, user, tweet_media)
+                except Exception as e:
+                    # one malformed tweet must not fail the rest of the batch
+                    logger.error(f"Could not parse tweet {tweet.id}")
+                    logger.error(e)
+                    self.resolve(tweet.id, exception=e)
+                    continue
+                self.cache[tweet.id] = (time.monotonic() + self.ttl, tweet_data)
+                self.resolve(tweet.id, result=tweet_data)
+
+            errors = {
+                int(error["resource_id"]): error.get("detail", "Not found")
+                for error in response.errors  # type: ignore
+                if error.get("resource_type") == "tweet" and "resource_id" in error
+            }
+            # deleted and protected tweets would otherwise be requested again on every lookup
+            expires = time.monotonic() + self.NOT_FOUND_TTL
+            for tweet_id in tweet_ids:
+                if tweet_id in self.in_flight:
+                    not_found = TweetNotFound(
+                        f"Could not get tweet `{tweet_id}`: {errors.get(tweet_id, 'Not found')}"
+                    )
+                    self.cache[tweet_id] = (expires, not_found)
+                    self.resolve(tweet_id, exception=not_found)
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        except Exception as e:
+            for tweet_id in tweet_ids:
+                self.resolve(tweet_id, exception=e)
+        finally:
+            # anything still pending was not in the response, never leave a caller waiting
+            for tweet_id in tweet_ids:
+                self.resolve(
+                    tweet_id,
+                    exception=TweetNotFound(
+                        f"Could not get tweet `{tweet_id}`: {errors.get(tweet_id, 'Not found')}"
+                    ),
+                )
+
+    def resolve(self, tweet_id: int, result=None, exception=None):
+        future = self.in_flight.pop(tweet_id, None)
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
 class TwitterRenderer:
     def __init__(self, bot):
-        self.bot: Siniara = bot
-
-    async def tweepy_tweet(self, tweet_id: int):
-        response = await self.bot.tweepy.get_tweet(
-            tweet_id,
-            tweet_fields=["attachments", "created_at", "conversation_id", "entities"],
-            expansions=["attachments.media_keys", "author_id"],
-            media_fields=["variants", "url", "alt_text"],
-            user_fields=["profile_image_url"],
-        )
+        self.bot: "Siniara" = bot
 
-        tweet: tweepy.Tweet = response.data  # type: ignore
+    async def tweepy_tweet(self, tweet_id: int) -> TweetData:
+        return await self.bot.tweet_loader.get(tweet_id)
 
-        # logger.info(tweet.data)
-        # logger.info(response.includes)
-        # logger.info(tweet.entities)
-
-        media = await self.tweepy_get_media(response)
-        user = response.includes["users"][0]  # type: ignore
+    @classmethod
+    def parse_tweet(cls, tweet: tweepy.Tweet, user: tweepy.User, media: list) -> TweetData:
         screen_name = user.username
         tweet_url = f"https://twitter.com/{screen_name}/status/{tweet.id}"
         timestamp = arrow.get(tweet.created_at)
         if tweet.entities is not None and tweet.entities.get("urls", False):
-            tweet_text = self.expand_links(tweet.text, tweet.entities["urls"])
+            tweet_text = cls.expand_links(tweet.text, tweet.entities["urls"])
         else:
             tweet_text = tweet.text
 
@@ -73,7 +232,7 @@ class TwitterRenderer:
         return TweetData(
             int(tweet["id"]),
             tweet["author_id"],
-            media,
+            cls.tweepy_get_media(media),
             screen_name,
             tweet_url,
             timestamp,
@@ -81,10 +240,10 @@ class TwitterRenderer:
             reply_to,
         )
 
-    async def tweepy_get_media(self, response):
+    @staticmethod
+    def tweepy_get_media(media_list: list[tweepy.Media]) -> list[tuple[str, str]]:
         media_urls = []
-        media: tweepy.Media
-        for media in response.includes.get("media", []):  # type: ignore
+        for media in media_list:
             if media.type == "photo":
                 base, extension = media.url.rsplit(".", 1)
                 media_urls.append(("jpg", base + "?format=" + extension + "&name=orig"))
@@ -106,7 +265,8 @@ class TwitterRenderer:
     ) -> None:
         """Format and send a tweet to given discord channels"""
         logger.info(f"sending {tweet_id} into {', '.join(f'#{c}' for c in channels)}")
-        tweet = await self.tweepy_tweet(tweet_id)
+        with tracing.span("hydrate"):
+            tweet = await self.tweepy_tweet(tweet_id)
 
         if tweet.id != tweet_id:
             logger.warning(f"Got id {tweet.id}, Possible retweet {tweet.url}")
@@ -116,6 +276,20 @@ class TwitterRenderer:
             f" <t:{tweet.timestamp.int_timestamp}:R>"
         )
 
+        with tracing.span("config"):
+            tweet_configs = await queries.tweet_configs(
+                self.bot.db, [c for c in channels if c.guild], tweet.author_id
+            )
+
+        # discord normally has 8MB file size limit, but it can be increased in some guilds
+        filesize_limits = {c.guild.filesize_limit for c in channels if c.guild}
+        media = []
+        if filesize_limits:
+            with tracing.span("download"):
+                media = await self.download_files(tweet, max(filesize_limits))
+        media_by_limit = {limit: self.split_media(media, limit) for limit in filesize_limits}
+
+        deliveries = []
         for channel in channels:
             if not channel.guild:
                 logger.warning(
@@ -123,7 +297,7 @@ class TwitterRenderer:
                 )
                 continue
 
-            tweet_config = await queries.tweet_config(self.bot.db, channel, tweet.author_id)
+            tweet_config = tweet_configs[channel.id]
 
             content = discord.Embed(color=int("1ca1f1", 16))
 
@@ -137,52 +311,86 @@ class TwitterRenderer:
 
                 content.description = description
 
-            # discord normally has 8MB file size limit, but it can be increased in some guilds
-            max_filesize = channel.guild.filesize_limit
-            files, too_big_files = await self.download_files(tweet, max_filesize)
-
-            if not files and not too_big_files and tweet_config["media_only"]:
+            if not media and tweet_config["media_only"]:
                 if interaction:
                     raise NoMedia
                 logger.warning(
                     f"There are no files to send in tweet id {tweet.id} destined for #{channel}"
                 )
+                metrics.TWEETS_FILTERED.inc()
                 continue
 
-            caption = "\n".join([caption] + too_big_files)
-            button = LinkButton("View on Twitter", tweet.url)
+            sendable_media, too_big_files = media_by_limit[channel.guild.filesize_limit]
+            message = "\n".join([caption] + too_big_files)
+            embed = content if content.description else discord.utils.MISSING
 
+            followup = None
             if (
                 interaction
                 and interaction.channel == channel
                 and not interaction.extras.get("responded_once", False)
             ):
-                await interaction.followup.send(
-                    caption,
-                    files=files,
-                    embed=content if content.description else discord.utils.MISSING,
-                    view=button,
-                )
+                followup = interaction
                 interaction.extras["responded_once"] = True
-            else:
-                try:
-                    await channel.send(
-                        caption,
-                        files=files,
-                        embed=content if content.description else discord.utils.MISSING,
-                        view=button,
-                    )
-                except discord.Forbidden:
-                    owner = self.bot.fetch_user(channel.guild.owner_id or 0)
-                    logger.warning(
-                        f"No permissions to send {tweet.id} into #{channel} in {channel.guild}, notifying owner ({owner})"
+
+            deliveries.append((channel, message, sendable_media, embed, followup))
+
+        # the earlier a message is in its tweet's fan-out, the sooner it gets a free slot,
+        # so every tweet reaches its first channel quickly even when the scheduler is busy
+        with tracing.span("fan_out"):
+            results = await asyncio.gather(
+                *(
+                    self.bot.send_scheduler.run(
+                        channel.id,
+                        channel.guild.id,  # type: ignore
+                        functools.partial(self.deliver, tweet, channel, *delivery),
+                        priority=priority,
                     )
-                    if channel.guild.owner:
-                        await channel.guild.owner.send(
-                            f"I tried to send a tweet by `@{tweet.screen_name}` "
-                            f"into <#{channel.id}> in your server **{channel.guild}**, "
-                            "but I don't have the permissions to do that! Please fix."
-                        )
+                    for priority, (channel, *delivery) in enumerate(deliveries)
+                ),
+                return_exceptions=True,
+            )
+        for (channel, *_), result in zip(deliveries, results):
+            if isinstance(result, Exception):
+                metrics.SEND_FAILURES.inc()
+                if interaction:
+                    raise result
+                logger.opt(exception=result).error(
+                    f"Failed to send tweet id {tweet.id} into #{channel}: {result}"
+                )
+
+    async def deliver(
+        self,
+        tweet: TweetData,
+        channel: SendableChannel,
+        message: str,
+        media: list[MediaFile],
+        embed: discord.Embed,
+        followup: Optional[discord.Interaction],
+    ):
+        files = [m.to_file() for m in media]
+        button = LinkButton("View on Twitter", tweet.url)
+        if followup:
+            await followup.followup.send(message, files=files, embed=embed, view=button)
+            return
+
+        try:
+            started = time.perf_counter()
+            with tracing.span("upload"):
+                await channel.send(message, files=files, embed=embed, view=button)
+            metrics.DISCORD_SEND_SECONDS.observe(time.perf_counter() - started)
+            tracing.delivered()
+        except discord.Forbidden:
+            owner = self.bot.fetch_user(channel.guild.owner_id or 0)  # type: ignore
+            logger.warning(
+                f"No permissions to send {tweet.id} into #{channel} in {channel.guild}, notifying owner ({owner})"
+            )
+            if channel.guild.owner:  # type: ignore
+                await channel.guild.owner.send(  # type: ignore
+                    f"I tried to send a tweet by `@{tweet.screen_name}` "
+                    f"into <#{channel.id}> in your server **{channel.guild}**, "
+                    "but I don't have the permissions to do that! Please fix."
+                )
 
     @staticmethod
     def expand_links(tweet_text: str, urls: list[dict]):
@@ -204,26 +412,40 @@ class TwitterRenderer:
 
         return "".join(results).strip()
 
-    async def download_files(
-        self, tweet: TweetData, max_filesize: int
-    ) -> tuple[list[discord.File], list[str]]:
-        files = []
+    @staticmethod
+    def split_media(media: list[MediaFile], max_filesize: int) -> tuple[list[MediaFile], list[str]]:
+        """Split media into files that can be uploaded and links to the ones that can't."""
+        sendable = []
         too_big_files = []
+        for media_file in media:
+            if media_file.fits(max_filesize):
+                sendable.append(media_file)
+            else:
+                too_big_files.append(media_file.link)
+
+        return sendable, too_big_files
+
+    async def download_files(self, tweet: TweetData, max_filesize: int) -> list[MediaFile]:
         tasks = []
         for n, (extension, media_url) in enumerate(tweet.media, start=1):
             filename = f"{tweet.timestamp.format('YYMMDD')}-@{tweet.screen_name}-{tweet.id}-{n}.{extension}"
             tasks.append(self.download_media(media_url, filename, max_filesize))
 
-        results = await asyncio.gather(*tasks)
-        for result in results:
-            if isinstance(result, discord.File):
-                files.append(result)
-            else:
-                too_big_files.append(result)
-
-        return files, too_big_files
-
-    async def download_media(self, media_url: str, filename: str, max_filesize: int):
+        return list(await asyncio.gather(*tasks))
+
+    async def download_media(self, media_url: str, filename: str, max_filesize: int) -> MediaFile:
+        try:
+            cached = await self.bot.media_cache.get(media_url)
+        except Exception as e:
+            logger.error(f"Could not read {media_url} from the media cache")
+            logger.error(e)
+            cached = None
+        if cached is not None:
+            if len(cached) < max_filesize:
+                return MediaFile(filename, media_url, data=cached)
+            return MediaFile(filename, media_url)
+
+        started = time.perf_counter()
         async with self.bot.session.get(media_url) as response:
             if not response.ok:
                 if response.headers.get("Content-Type") == "text/plain":
@@ -233,26 +455,48 @@ class TwitterRenderer:
                     error_message = f"{response.status} {response.reason}"
 
                 logger.error(error_message)
-                return f"`[{error_message}]`"
+                return MediaFile(filename, media_url, error=f"`[{error_message}]`")
 
             content_length = response.headers.get("Content-Length") or response.headers.get(
                 "x-full-image-content-length"
             )
             if content_length:
                 if int(content_length) < max_filesize:
-                    buffer = io.BytesIO(await response.read())
-                    return discord.File(fp=buffer, filename=filename)
-                elif int(content_length) >= max_filesize:
-                    return media_url
+                    data = await response.read()
+                else:
+                    return MediaFile(filename, media_url)
             else:
                 # there is no Content-Length header
                 # try to stream until we hit our limit
-                try:
-                    buffer = b""
-                    async for chunk in response.content.iter_chunked(1024):
-                        buffer += chunk
-                        if len(buffer) > max_filesize:
-                            raise ValueError
-                    return discord.File(fp=io.BytesIO(buffer), filename=filename)
-                except ValueError:
-                    return media_url
+                data = await self.read_limited(response, max_filesize)
+                if data is None:
+                    return MediaFile(filename, media_url)
+
+            metrics.MEDIA_DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+            metrics.MEDIA_DOWNLOAD_BYTES.observe(len(data))
+            try:
+                await self.bot.media_cache.put(media_url, data, response.headers)
+            except Exception as e:
+                logger.error(f"Could not write {media_url} to the media cache")
+                logger.error(e)
+            return MediaFile(filename, media_url, data=data)
+
+    @staticmethod
+    async def read_limited(response, max_filesize: int) -> Optional[bytes]:
+        """Stream a response of unknown length, giving up as soon as it grows past max_filesize.
+
+        Chunks are spooled to a temporary file once they go over SPOOL_SIZE, so memory stays
+        bounded while downloading and the finished file is read back with a single allocation.
+        """
+        chunk_size = MIN_CHUNK_SIZE
+        size = 0
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            while chunk := await response.content.read(chunk_size):
+                size += len(chunk)
+                if size > max_filesize:
+                    return None
+                spool.write(chunk)
+                chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+            spool.seek(0)
+            return spool.read()
@@ -2,7 +2,7 @@ from typing import Generic, TypeVar
 
 import discord
 
-from modules import queries
+from modules.settings import GuildSettingsSnapshot
 
 T = TypeVar("T")
 STYLE = discord.ButtonStyle.blurple
@@ -223,24 +223,15 @@ class SettingsMenu(discord.ui.View):
         super().__init__()
         self.bot = bot
         self.embed = discord.Embed(title="Send only tweets with media?")
+        self.snapshot: GuildSettingsSnapshot
 
     @discord.ui.button(label="Server wide")
     async def media_only_guild(self, interaction, button):
-        button.value = (button.value + 1) % 2
-        button.emoji = ON_OFF[button.value]
-        await queries.set_config_guild(
-            self.bot.db, interaction.guild_id, "media_only", button.value
-        )
-        await interaction.response.edit_message(view=self)
+        await self.toggle(interaction, "media_only")
 
     @discord.ui.button(label="Show captions")
     async def show_captions(self, interaction, button):
-        button.value = (button.value + 1) % 2
-        button.emoji = ON_OFF[button.value]
-        await queries.set_config_guild(
-            self.bot.db, interaction.guild_id, "show_captions", button.value
-        )
-        await interaction.response.edit_message(view=self)
+        await self.toggle(interaction, "show_captions")
 
     @discord.ui.button(label="Channel rules")
     async def channel_rules(self, interaction, button):
@@ -250,31 +241,30 @@ class SettingsMenu(discord.ui.View):
     async def user_rules(self, interaction, button):
         await UserRules(self).render(interaction)
 
-    async def render(self, interaction):
-        media_only_data, show_captions_data = await self.bot.db.execute(
-            "SELECT media_only, show_captions FROM guild_settings WHERE guild_id = %s",
-            interaction.guild_id,
-            one_row=True,
-        ) or [None, None]
-
-        if show_captions_data is None:
-            show_captions_data = 0
-        if media_only_data is None:
-            media_only_data = 0
-
-        self.media_only_guild.value = media_only_data  # type: ignore
-        self.media_only_guild.emoji = ON_OFF[media_only_data]
+    async def toggle(self, interaction, setting):
+        self.snapshot.set(setting, ((getattr(self.snapshot, setting) or 0) + 1) % 2)
+        self.update_buttons()
+        await interaction.response.edit_message(view=self)
 
-        self.show_captions.value = show_captions_data  # type: ignore
-        self.show_captions.emoji = ON_OFF[show_captions_data]
+    def update_buttons(self):
+        self.media_only_guild.emoji = ON_OFF[self.snapshot.media_only or 0]
+        self.show_captions.emoji = ON_OFF[self.snapshot.show_captions or 0]
 
+    async def run(self, interaction):
+        self.snapshot = await GuildSettingsSnapshot.load(self.bot, interaction.guild_id)
+        self.update_buttons()
         await interaction.response.send_message(embed=self.embed, view=self)
 
+    async def render(self, interaction):
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.embed, view=self)
+
 
 class SubMenu(discord.ui.View):
     def __init__(self, parent_view):
         super().__init__()
         self.parent_view = parent_view
+        self.snapshot: GuildSettingsSnapshot = parent_view.snapshot
 
     @discord.ui.button(label="Back")
     async def go_back(self, interaction, button):
@@ -289,18 +279,15 @@ class SubMenu(discord.ui.View):
 
 
 class RemoveRule(SubMenu):
-    def __init__(self, parent_view, table, options):
+    def __init__(self, parent_view, kind, options):
         super().__init__(parent_view)
         self.selected_rule.options = options
-        self.table = table
+        self.kind = kind
         self.go_back.row = 1
 
     @discord.ui.select(row=0)
     async def selected_rule(self, interaction, select):
-        await interaction.client.db.execute(
-            f"DELETE FROM {self.table} WHERE rule_id = %s",
-            int(select.values[0]),
-        )
+        self.snapshot.remove_rule(self.kind, int(select.values[0]))
         select.options = list(filter(lambda x: str(x.value) != select.values[0], select.options))
         if not select.options:
             self.remove_item(select)
@@ -313,15 +300,11 @@ class RemoveRule(SubMenu):
 
 class UserRules(SubMenu):
     async def update_embed(self, interaction):
-        user_settings = await interaction.client.db.execute(
-            """
-            SELECT rule_id, twitter_user.username, media_only
-            FROM user_rule RIGHT OUTER JOIN twitter_user
-            ON twitter_user.user_id = user_rule.twitter_user_id
-            WHERE guild_id = %s
-            """,
-            interaction.guild_id,
-        )
+        twitter_users = interaction.client.twitter_users
+        user_settings = [
+            (rule_id, twitter_users.get_username(user_id) or user_id, val)
+            for rule_id, (user_id, val) in self.snapshot.rules["user"].items()
+        ]
         content = discord.Embed(
             title="User rules",
             description="\n".join(
@@ -345,15 +328,14 @@ class UserRules(SubMenu):
 
     @discord.ui.button(label="Remove rule")
     async def remove_rule(self, interaction, button):
-        await RemoveRule(self, "user_rule", self.options).render(interaction)
+        await RemoveRule(self, "user", self.options).render(interaction)
 
 
 class ChannelRules(SubMenu):
     async def update_embed(self, interaction):
-        channel_settings = await interaction.client.db.execute(
-            "SELECT rule_id, channel_id, media_only FROM channel_rule WHERE guild_id = %s",
-            interaction.guild_id,
-        )
+        channel_settings = [
+            (rule_id, cid, val) for rule_id, (cid, val) in self.snapshot.rules["channel"].items()
+        ]
         content = discord.Embed(
             title="Channel rules",
             description="\n".join(
@@ -377,7 +359,7 @@ class ChannelRules(SubMenu):
 
     @discord.ui.button(label="Remove rule")
     async def remove_rule(self, interaction, button):
-        await RemoveRule(self, "channel_rule", self.options).render(interaction)
+        await RemoveRule(self, "channel", self.options).render(interaction)
 
 
 class LinkButton(discord.ui.View):
@@ -0,0 +1,7 @@
+-- follows are looked up by twitter user when a tweet comes in,
+-- and by guild for follow limits, /list and /rule user
+CREATE INDEX IF NOT EXISTS follow_by_user ON follow (twitter_user_id, channel_id);
+CREATE INDEX IF NOT EXISTS follow_by_guild ON follow (guild_id, twitter_user_id);
+
+-- the settings menu loads every channel rule of a guild
+CREATE INDEX IF NOT EXISTS channel_rule_by_guild ON channel_rule (guild_id);
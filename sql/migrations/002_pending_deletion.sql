@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS pending_deletion (
+    channel_id BIGINT,
+    twitter_user_id BIGINT,
+    queued_on DATETIME,
+    PRIMARY KEY (channel_id, twitter_user_id)
+);
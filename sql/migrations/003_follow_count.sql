@@ -0,0 +1,6 @@
+-- distinct twitter users followed in the guild, kept up to date by every follow change
+ALTER TABLE guild ADD COLUMN IF NOT EXISTS follow_count INT NOT NULL DEFAULT 0;
+
+UPDATE guild SET follow_count = (
+    SELECT COUNT(DISTINCT twitter_user_id) FROM follow WHERE follow.guild_id = guild.guild_id
+);
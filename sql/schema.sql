@@ -7,6 +7,7 @@ CREATE TABLE twitter_user (
 CREATE TABLE guild (
     guild_id BIGINT,
     follow_limit INT,
+    follow_count INT NOT NULL DEFAULT 0,
     PRIMARY KEY (guild_id)
 );
 
@@ -16,6 +17,8 @@ CREATE TABLE follow (
     twitter_user_id BIGINT,
     added_on DATETIME,
     PRIMARY KEY (channel_id, twitter_user_id),
+    INDEX follow_by_user (twitter_user_id, channel_id),
+    INDEX follow_by_guild (guild_id, twitter_user_id),
     FOREIGN KEY (twitter_user_id) REFERENCES twitter_user (user_id) ON DELETE CASCADE ON UPDATE CASCADE
 );
 
@@ -32,7 +35,8 @@ CREATE TABLE channel_rule (
     channel_id BIGINT,
     media_only BOOL,
     PRIMARY KEY (rule_id),
-    UNIQUE (channel_id)
+    UNIQUE (channel_id),
+    INDEX channel_rule_by_guild (guild_id)
 );
 
 CREATE TABLE user_rule (
@@ -43,4 +47,11 @@ CREATE TABLE user_rule (
     PRIMARY KEY (rule_id),
     UNIQUE (guild_id, twitter_user_id),
     FOREIGN KEY (twitter_user_id) REFERENCES twitter_user (user_id) ON DELETE CASCADE ON UPDATE CASCADE
-);
\ No newline at end of file
+);
+
+CREATE TABLE pending_deletion (
+    channel_id BIGINT,
+    twitter_user_id BIGINT,
+    queued_on DATETIME,
+    PRIMARY KEY (channel_id, twitter_user_id)
+);